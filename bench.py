@@ -0,0 +1,289 @@
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+
+import utils
+from config import RENDER_QUALITY_PROFILES, RENDER_QUALITY, RENDER_ENGINE, RENDER_WORKERS
+
+# Набір цитат для заміру: коротка, середня, довга, з кирилицею і з емодзі
+SAMPLES = [
+    ("Привіт!", "Геймер", "blue"),
+    ("This is a medium length quote to check how wrapping behaves in the bubble.", "John Smith", "red"),
+    ("Довга цитата, яка займає кілька рядків і перевіряє, як бот справляється з великою кількістю тексту "
+     "в одній бульбашці. " * 3, "Олександр Довгоіменний", "green"),
+    ("Emoji test 😎🔥👍", "Emoji Fan 🎉", "purple"),
+]
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))
+    return values[index]
+
+def psnr(webp_a, webp_b):
+    """PSNR між двома стікерами (дБ), більше - ближче до еталону"""
+    a = Image.open(io.BytesIO(webp_a)).convert("RGBA")
+    b = Image.open(io.BytesIO(webp_b)).convert("RGBA")
+    # Висота може відрізнятися на піксель через округлення
+    size = (min(a.width, b.width), min(a.height, b.height))
+    a, b = a.crop((0, 0) + size), b.crop((0, 0) + size)
+    diff = ImageChops.difference(a, b)
+    mse = sum(v ** 2 for v in ImageStat.Stat(diff).rms) / 4
+    return float("inf") if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+async def render_once(engine, text, name, color, quality):
+    if engine == "native":
+        return await utils.image_executor.run(utils.render_webp_native, text, name, color, None, 'dark', quality)
+    return await utils.render_webp(text, name, color, theme='dark', quality=quality)
+
+async def bench_quality(engine, runs):
+    """Затримка, розмір і PSNR кожного профілю відносно "max" """
+    await utils.startup_browser()
+    samples = SAMPLES if engine == "browser" else [s for s in SAMPLES if utils.can_render_native(s[0], s[1])]
+    reference = {}
+    try:
+        for quality in ["max"] + [q for q in RENDER_QUALITY_PROFILES if q != "max"]:
+            latencies, sizes, scores = [], [], []
+            for text, name, color in samples:
+                # Перший рендер - прогрів сторінки цього масштабу
+                output = await render_once(engine, text, name, color, quality)
+                for _ in range(runs):
+                    started = time.perf_counter()
+                    output = await render_once(engine, text, name, color, quality)
+                    latencies.append((time.perf_counter() - started) * 1000)
+                sizes.append(len(output))
+                if quality == "max":
+                    reference[text] = output
+                else:
+                    scores.append(psnr(reference[text], output))
+            print(
+                f"{quality:<9} p50 {statistics.median(latencies):7.1f} ms  "
+                f"p95 {percentile(latencies, 95):7.1f} ms  "
+                f"avg size {statistics.mean(sizes) / 1024:6.1f} KiB  "
+                f"PSNR vs max {statistics.mean(scores) if scores else float('inf'):6.2f} dB"
+            )
+    finally:
+        await utils.shutdown_browser()
+
+# --- НАБІР ЗАМІРІВ render_sticker ---
+WORDS = "lorem ipsum dolor sit amet привіт як справи цитата тест".split()
+
+class StubBot:
+    """Бот-заглушка: зберігає байти стікерів замість відправки в Telegram"""
+
+    def __init__(self):
+        self.stickers = []
+        self.errors = []
+
+    async def send_sticker(self, chat_id, sticker):
+        self.stickers.append(sticker.data)
+        # sticker=None - кеш file_id не заповнюється
+        return type("Message", (), {"sticker": None})()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.errors.append(text)
+
+def make_text(length, seed):
+    words = itertools.cycle(WORDS[seed % len(WORDS):] + WORDS[:seed % len(WORDS)])
+    text = ""
+    while len(text) < length:
+        text += next(words) + " "
+    return text[:length].strip() or "x"
+
+def make_image(width, height, color):
+    """Синтетичне фото з градієнтом (як реальне - погано стискається)"""
+    image = Image.new("RGB", (width, height), color)
+    draw = ImageDraw.Draw(image)
+    for y in range(0, height, 4):
+        draw.line([(0, y), (width, y)], fill=((y * 7) % 256, (y * 3) % 256, (y * 5) % 256))
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return "unknown"
+
+async def sample_rss(peak, stop):
+    while not stop.is_set():
+        peak[0] = max(peak[0], utils.process_tree_rss())
+        try: await asyncio.wait_for(stop.wait(), 0.1)
+        except asyncio.TimeoutError: pass
+
+async def run_case(case, runs, quality, avatar, content):
+    bot = StubBot()
+    latencies = []
+    semaphore = asyncio.Semaphore(case["concurrency"])
+
+    async def one(i):
+        # Унікальний текст, щоб не влучати в кеш стікерів
+        text = make_text(case["text_length"], i) + f" #{i}"
+        name = make_text(case["name_length"], i + 1)
+        async with semaphore:
+            started = time.perf_counter()
+            await utils.render_sticker(
+                bot, 0, text, name, i, avatar if case["avatar"] else None,
+                content if case["content_image"] else None, case["theme"], quality
+            )
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    # Прогрів (пул сторінок потрібного масштабу, шрифти)
+    await one(-1)
+    latencies.clear()
+    bot.stickers.clear()
+
+    peak = [0]
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_rss(peak, stop))
+    started = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(runs * case["concurrency"])])
+    wall = time.perf_counter() - started
+    stop.set()
+    await sampler
+
+    sizes = [len(data) for data in bot.stickers]
+    return dict(
+        case,
+        renders=len(latencies),
+        errors=len(bot.errors),
+        p50_ms=percentile(latencies, 50),
+        p95_ms=percentile(latencies, 95),
+        p99_ms=percentile(latencies, 99),
+        mean_ms=statistics.mean(latencies),
+        throughput_rps=len(latencies) / wall,
+        peak_rss_mb=peak[0] / 1024 / 1024,
+        output_bytes=statistics.mean(sizes) if sizes else 0,
+    )
+
+async def bench_render(args):
+    """Матриця: довжина тексту/імені, тема, аватарка, фото, паралельність"""
+    utils.sticker_cache.max_size = 0
+    if RENDER_WORKERS > 0: await utils.start_render_workers(RENDER_WORKERS)
+    else: await utils.startup_browser()
+    avatar = make_image(640, 640, "#4cb8dd")
+    content = make_image(1280, 720, "#f17055")
+    matrix = itertools.product(
+        args.text_lengths, args.name_lengths, args.themes,
+        [False, True], [False, True], args.concurrency
+    )
+    results = []
+    try:
+        for text_length, name_length, theme, with_avatar, with_content, concurrency in matrix:
+            case = dict(
+                text_length=text_length, name_length=name_length, theme=theme,
+                avatar=with_avatar, content_image=with_content, concurrency=concurrency
+            )
+            result = await run_case(case, args.runs, args.quality, avatar, content)
+            results.append(result)
+            print(
+                f"text={text_length:<4} name={name_length:<3} {theme:<5} "
+                f"ava={int(with_avatar)} img={int(with_content)} c={concurrency:<3} "
+                f"p50 {result['p50_ms']:7.1f}  p95 {result['p95_ms']:7.1f}  p99 {result['p99_ms']:7.1f} ms  "
+                f"{result['throughput_rps']:6.1f} rps  rss {result['peak_rss_mb']:6.0f} MB  "
+                f"{result['output_bytes'] / 1024:5.1f} KiB"
+            )
+    finally:
+        await utils.stop_render_workers()
+        await utils.shutdown_browser()
+        utils.image_executor.shutdown()
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "quality": args.quality or RENDER_QUALITY,
+            "engine": RENDER_ENGINE,
+            "workers": RENDER_WORKERS,
+            "runs": args.runs,
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join("bench_results", f"render-{report['meta']['commit']}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Saved to {output}")
+
+CASE_FIELDS = ("text_length", "name_length", "theme", "avatar", "content_image", "concurrency")
+
+def compare(baseline_path, current_path):
+    """Порівнює два JSON-звіти bench.py render (зміна p50/p95/rps у відсотках)"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(current_path, encoding="utf-8") as f:
+        current = json.load(f)
+    base = {tuple(r[k] for k in CASE_FIELDS): r for r in baseline["results"]}
+    print(f"{baseline['meta']['commit']} -> {current['meta']['commit']}")
+    for result in current["results"]:
+        key = tuple(result[k] for k in CASE_FIELDS)
+        old = base.get(key)
+        if not old:
+            continue
+        delta = lambda field: (result[field] - old[field]) / old[field] * 100 if old[field] else 0.0
+        print(
+            f"text={key[0]:<4} name={key[1]:<3} {key[2]:<5} ava={int(key[3])} img={int(key[4])} c={key[5]:<3} "
+            f"p50 {delta('p50_ms'):+6.1f}%  p95 {delta('p95_ms'):+6.1f}%  rps {delta('throughput_rps'):+6.1f}%"
+        )
+
+def smoke():
+    """Швидка перевірка нативного рушія: стікер без аватарки і з фото-аватаркою"""
+    avatar = make_image(640, 640, "#4cb8dd")
+    outputs = {}
+    for label, photo in (("letter", None), ("photo", avatar)):
+        for text, name, color in SAMPLES[:2]:
+            output = utils.render_webp_native(text, name, color, photo, 'dark')
+            assert isinstance(output, bytes) and output, f"native {label}: empty output"
+            assert Image.open(io.BytesIO(output)).format == "WEBP", f"native {label}: not a WebP"
+        outputs[label] = Image.open(io.BytesIO(output)).convert("RGB")
+        print(f"native {label}: ok ({len(output)} B)")
+    # Фото має бути видно: аватарка відрізняється від варіанта з літерою
+    assert ImageChops.difference(outputs["letter"], outputs["photo"]).getbbox(), "native photo: avatar ignored"
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк рендеру стікерів")
+    sub = parser.add_subparsers(dest="command", required=True)
+    quality = sub.add_parser("quality", help="порівняти профілі якості")
+    quality.add_argument("--engine", choices=["browser", "native"], default="browser")
+    quality.add_argument("--runs", type=int, default=10)
+    render = sub.add_parser("render", help="матриця замірів render_sticker зі збереженням у JSON")
+    render.add_argument("--text-lengths", type=int_list, default=[10, 80, 300])
+    render.add_argument("--name-lengths", type=int_list, default=[5, 30])
+    render.add_argument("--themes", type=lambda v: v.split(","), default=["dark", "light"])
+    render.add_argument("--concurrency", type=int_list, default=[1, 4])
+    render.add_argument("--runs", type=int, default=5, help="рендерів на одного паралельного клієнта")
+    render.add_argument("--quality", choices=list(RENDER_QUALITY_PROFILES), default=None)
+    render.add_argument("--output", default=None)
+    sub.add_parser("smoke", help="перевірити, що нативний рушій повертає WebP з аватаркою і без")
+    comp = sub.add_parser("compare", help="порівняти два JSON-звіти")
+    comp.add_argument("baseline")
+    comp.add_argument("current")
+    args = parser.parse_args()
+    if args.command == "quality":
+        asyncio.run(bench_quality(args.engine, args.runs))
+    elif args.command == "render":
+        asyncio.run(bench_render(args))
+    elif args.command == "compare":
+        compare(args.baseline, args.current)
+    elif args.command == "smoke":
+        smoke()
+
+if __name__ == "__main__":
+    main()
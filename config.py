@@ -1,3 +1,4 @@
+import hashlib
 import os
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
@@ -22,6 +23,194 @@ COLOR_KEY_TO_ID = {
     "cyan": 4, "blue": 5, "pink": 6, "gold": 1
 }
 
+# --- ПУЛ СТОРІНОК БРАУЗЕРА ---
+# Скільки прогрітих сторінок створюється при старті і скільки максимум може існувати одночасно
+PAGE_POOL_MIN = int(os.environ.get("PAGE_POOL_MIN", 2))
+PAGE_POOL_MAX = int(os.environ.get("PAGE_POOL_MAX", 4))
+
+# --- ЧЕРГА РЕНДЕРУ ---
+# Максимум одночасних рендерів і довжина черги очікування (решта отримує відмову)
+RENDER_MAX_IN_FLIGHT = int(os.environ.get("RENDER_MAX_IN_FLIGHT", 4))
+RENDER_MAX_QUEUE = int(os.environ.get("RENDER_MAX_QUEUE", 20))
+# Скільки рендерів один користувач може тримати в черзі (черга обслуговує користувачів по колу)
+RENDER_MAX_QUEUE_PER_USER = int(os.environ.get("RENDER_MAX_QUEUE_PER_USER", 2))
+
+# --- ОБМЕЖЕННЯ ЧАСТОТИ ---
+# Відра токенів на користувача: (токенів за секунду, місткість)
+# "ui" - кнопки і команди, "render" - рендер і завантаження фото
+THROTTLE_LIMITS = {
+    "ui": (float(os.environ.get("THROTTLE_UI_RATE", 2)), int(os.environ.get("THROTTLE_UI_BURST", 10))),
+    "render": (float(os.environ.get("THROTTLE_RENDER_RATE", 0.5)), int(os.environ.get("THROTTLE_RENDER_BURST", 6))),
+}
+# "memory" - ліміти в процесі, "redis" - спільні для кількох реплік (потрібен пакет redis)
+THROTTLE_STORE = os.environ.get("THROTTLE_STORE", "memory")
+THROTTLE_REDIS_URL = os.environ.get("THROTTLE_REDIS_URL", "redis://localhost:6379/0")
+
+# --- ВИХІДНІ ЗАПИТИ ДО TELEGRAM ---
+# Відра (запитів за секунду, місткість) для відправки, редагування і видалення повідомлень:
+# на всього бота, на особистий чат і на групу/канал
+OUTBOUND_GLOBAL_LIMIT = (float(os.environ.get("OUTBOUND_GLOBAL_RATE", 25)), int(os.environ.get("OUTBOUND_GLOBAL_BURST", 30)))
+OUTBOUND_CHAT_LIMIT = (float(os.environ.get("OUTBOUND_CHAT_RATE", 1)), int(os.environ.get("OUTBOUND_CHAT_BURST", 5)))
+OUTBOUND_GROUP_LIMIT = (float(os.environ.get("OUTBOUND_GROUP_RATE", 20 / 60)), int(os.environ.get("OUTBOUND_GROUP_BURST", 5)))
+# Скільки разів повторювати запит після 429 (retry_after)
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", 3))
+# Однакова дія ("typing", "choose_sticker") в той самий чат не частіше (секунди)
+CHAT_ACTION_INTERVAL = float(os.environ.get("CHAT_ACTION_INTERVAL", 4.5))
+
+# --- ПРОЦЕСИ-ВОРКЕРИ ---
+# 0 - рендер у головному процесі, N - N процесів, кожен зі своїм Chromium
+# (RENDER_MAX_IN_FLIGHT варто ставити не меншим за кількість воркерів)
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", 0))
+
+# --- РУШІЙ РЕНДЕРУ ---
+# "auto" - прості текстові цитати малюються через Pillow, решта через браузер
+# "browser" - завжди браузер
+RENDER_ENGINE = os.environ.get("RENDER_ENGINE", "auto")
+
+# Максимум очікування шрифтів і картинок перед скріншотом (мс)
+RENDER_READY_TIMEOUT_MS = int(os.environ.get("RENDER_READY_TIMEOUT_MS", 2000))
+
+# "patch" - сторінка завантажує шаблон один раз, а кожен рендер лише оновлює поля цитат
+# одним page.evaluate; "set_content" - кожен рендер завантажує весь HTML заново
+RENDER_MODE = os.environ.get("RENDER_MODE", "patch")
+
+# --- НАГЛЯД ЗА БРАУЗЕРОМ ---
+# Браузер замінюється свіжим після стількох проходів рендеру (0 - ніколи)...
+BROWSER_RECYCLE_RENDERS = int(os.environ.get("BROWSER_RECYCLE_RENDERS", 5000))
+# ...або коли Chromium з усіма дочірніми процесами займає більше (МБ, 0 - не перевіряти)
+BROWSER_RECYCLE_RSS_MB = int(os.environ.get("BROWSER_RECYCLE_RSS_MB", 1024))
+# Як часто перевіряти, що браузер відповідає, і його пам'ять (секунди)
+BROWSER_CHECK_INTERVAL = int(os.environ.get("BROWSER_CHECK_INTERVAL", 30))
+BROWSER_PROBE_TIMEOUT = int(os.environ.get("BROWSER_PROBE_TIMEOUT", 10))
+# Скільки старий браузер чекає на незавершені рендери перед закриттям (секунди)
+BROWSER_DRAIN_TIMEOUT = int(os.environ.get("BROWSER_DRAIN_TIMEOUT", 60))
+
+# --- ДЕДЛАЙНИ ---
+# Скільки максимум триває запит від натискання до стікера: завантаження, черга, рендер, відправка (секунди)
+RENDER_DEADLINE_S = float(os.environ.get("RENDER_DEADLINE_S", 30))
+# Межа однієї операції Playwright (set_content, скріншот), щоб завислий крок не з'їв увесь дедлайн (мс)
+PAGE_OP_TIMEOUT_MS = int(os.environ.get("PAGE_OP_TIMEOUT_MS", 10000))
+# Скидання сторінки після рендеру; не встигла - сторінка закривається (секунди)
+PAGE_RESET_TIMEOUT_S = float(os.environ.get("PAGE_RESET_TIMEOUT_S", 5))
+
+# --- ВИДАЛЕННЯ ПОВІДОМЛЕНЬ ---
+# Найраніше повідомлення чекає до стількох мс після свого строку, щоб разом з наступними піти одним delete_messages
+DELETE_BATCH_WINDOW_MS = int(os.environ.get("DELETE_BATCH_WINDOW_MS", 200))
+# Не більше стількох викликів видалення на секунду (0 - без обмеження)
+DELETE_RATE = float(os.environ.get("DELETE_RATE", 20))
+
+# --- ПАКЕТНИЙ РЕНДЕР ---
+# Поки сторінка браузера зайнята, нові цитати чекають до RENDER_BATCH_WINDOW_MS
+# і рендеряться разом в одній сторінці (не більше RENDER_BATCH_MAX). 0 - вимкнено
+RENDER_BATCH_WINDOW_MS = int(os.environ.get("RENDER_BATCH_WINDOW_MS", 20))
+RENDER_BATCH_MAX = int(os.environ.get("RENDER_BATCH_MAX", 4))
+
+# --- ОБРОБКА ЗОБРАЖЕНЬ ---
+# Pillow (зменшення, WebP, нативний рушій, фото) виконується поза циклом asyncio:
+# "thread" - пул потоків, "process" - пул процесів; IMAGE_WORKERS - скільки задач одночасно
+IMAGE_EXECUTOR = os.environ.get("IMAGE_EXECUTOR", "thread")
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 2))
+
+# --- ЯКІСТЬ РЕНДЕРУ ---
+# scale - device_scale_factor сторінки браузера, resample - фільтр зменшення до 512px,
+# supersample - масштаб малювання нативного рушія, webp_method - зусилля WebP-кодера (0-6)
+RENDER_QUALITY_PROFILES = {
+    "fast": {"scale": 1.0, "resample": "bilinear", "supersample": 1, "webp_method": 2},
+    "balanced": {"scale": 2.0, "resample": "bicubic", "supersample": 2, "webp_method": 4},
+    "max": {"scale": 3.0, "resample": "lanczos", "supersample": 2, "webp_method": 4},
+}
+# Профіль за замовчуванням (render_sticker може отримати інший через quality=...)
+RENDER_QUALITY = os.environ.get("RENDER_QUALITY", "max")
+
+# --- ШРИФТИ ---
+FONTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+# Де ще шукати шрифти, якщо їх немає в папці проєкту (пакет fonts-roboto у Docker)
+FONT_SYSTEM_DIRS = [
+    "/usr/share/fonts/truetype/roboto/unhinted/RobotoTTF",
+    "/usr/share/fonts/truetype/roboto/hinted",
+    "/usr/share/fonts/truetype/roboto",
+]
+# Адреса, з якої сторінки рендеру беруть шрифти з папки проєкту (відповідь дає сам бот через page.route),
+# щоб не вбудовувати ~1 МБ base64 у кожен HTML
+FONT_BASE_URL = "https://fonts.quoteyou.invalid/"
+# Вага шрифту -> файл
+FONT_FILES = {
+    400: "Roboto-Regular.ttf",
+    500: "Roboto-Medium.ttf",
+    700: "Roboto-Bold.ttf",
+}
+# Вага шрифту -> локальні назви для @font-face local()
+FONT_LOCAL_NAMES = {
+    400: ["Roboto", "Roboto-Regular"],
+    500: ["Roboto Medium", "Roboto-Medium"],
+    700: ["Roboto Bold", "Roboto-Bold"],
+}
+EMOJI_FONT_LOCAL_NAMES = ["Noto Color Emoji", "NotoColorEmoji"]
+
+# --- КЕШ СТІКЕРІВ ---
+# Однакові цитати не рендеряться вдруге, а пересилаються за file_id
+STICKER_CACHE_SIZE = int(os.environ.get("STICKER_CACHE_SIZE", 1000))
+STICKER_CACHE_TTL = int(os.environ.get("STICKER_CACHE_TTL", 24 * 3600))  # секунди
+# Змінюй при зміні вигляду стікера, щоб старі file_id з кешу не використовувались
+TEMPLATE_VERSION = "1"
+
+# --- КЕШ АВАТАРОК ---
+# Скільки часу аватарка вважається актуальною без запитів до Bot API (секунди)
+AVATAR_CACHE_TTL = int(os.environ.get("AVATAR_CACHE_TTL", 600))
+# Скільки пам'ятати, що в користувача немає фото профілю
+AVATAR_CACHE_NEGATIVE_TTL = int(os.environ.get("AVATAR_CACHE_NEGATIVE_TTL", 300))
+AVATAR_CACHE_SIZE = int(os.environ.get("AVATAR_CACHE_SIZE", 500))
+
+# --- HTTP КЛІЄНТ (завантаження файлів з Bot API) ---
+HTTP_POOL_LIMIT = int(os.environ.get("HTTP_POOL_LIMIT", 100))
+HTTP_LIMIT_PER_HOST = int(os.environ.get("HTTP_LIMIT_PER_HOST", 20))
+HTTP_KEEPALIVE = float(os.environ.get("HTTP_KEEPALIVE", 60))  # секунди
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 30))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 10))
+
+# --- СХОВИЩЕ FSM ---
+# "sqlite" - налаштування і сесії переживають перезапуск, "memory" - усе в пам'яті
+FSM_STORAGE = os.environ.get("FSM_STORAGE", "sqlite")
+FSM_DB_PATH = os.environ.get("FSM_DB_PATH", "data/fsm.sqlite3")
+# Через скільки секунд неактивна сесія редактора видаляється (налаштування лишаються)
+FSM_SESSION_TTL = int(os.environ.get("FSM_SESSION_TTL", 24 * 3600))
+FSM_EXPIRY_INTERVAL = int(os.environ.get("FSM_EXPIRY_INTERVAL", 600))
+
+# --- СХОВИЩЕ ЗОБРАЖЕНЬ ---
+# Аватарки і фото сесій зберігаються тут, а в FSM лише їхні ключі
+BLOB_MEMORY_LIMIT = int(os.environ.get("BLOB_MEMORY_LIMIT", 64 * 1024 * 1024))  # байти (кеш у пам'яті)
+# Папка, куди кожне зображення одразу пишеться на диск (порожньо - лише пам'ять).
+# Зі сховищем FSM "sqlite" сесії переживають перезапуск, тож і зображення мають жити поруч
+BLOB_DISK_DIR = os.environ.get("BLOB_DISK_DIR", "data/blobs" if FSM_STORAGE == "sqlite" else "")
+# Скільки живе зображення покинутої сесії (секунди) - не менше, ніж сама сесія
+BLOB_TTL = int(os.environ.get("BLOB_TTL", FSM_SESSION_TTL))
+
+# --- ЗАВАНТАЖЕННЯ ФОТО ---
+# Аватарка рендериться 100px при масштабі 3x, картинка - не ширше за бульбашку
+AVATAR_TARGET_PX = int(os.environ.get("AVATAR_TARGET_PX", 300))
+CONTENT_IMAGE_TARGET_PX = int(os.environ.get("CONTENT_IMAGE_TARGET_PX", 960))
+# Жорстка межа розміру файлу, який бот погоджується завантажити
+MAX_DOWNLOAD_BYTES = int(os.environ.get("MAX_DOWNLOAD_BYTES", 5 * 1024 * 1024))
+
+# --- WEBHOOK ---
+# Публічна адреса бота (напр. https://bot.example.com). Порожньо - long polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+# Telegram надсилає його в X-Telegram-Bot-Api-Secret-Token; за замовчуванням виводиться з токена,
+# щоб усі репліки мали однаковий
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+
+# --- INLINE-РЕЖИМ ---
+# Чат, куди бот завантажує inline-стікери, щоб отримати file_id (0 - inline вимкнено).
+# Найкраще - особистий чат з ботом (свій user id): у групу Telegram пускає лише ~20 повідомлень за хвилину
+INLINE_STORAGE_CHAT_ID = int(os.environ.get("INLINE_STORAGE_CHAT_ID", 0))
+# Пауза після останнього натискання клавіші перед рендером (мс)
+INLINE_DEBOUNCE_MS = int(os.environ.get("INLINE_DEBOUNCE_MS", 400))
+# Скільки часу є на відповідь, поки Telegram ще чекає (секунди, разом з паузою)
+INLINE_BUDGET_S = float(os.environ.get("INLINE_BUDGET_S", 7))
+# Скільки Telegram кешує відповідь на той самий запит користувача (секунди)
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", 300))
+
 LANGUAGES = {
     'ua': "🇺🇦 Українська",
     'en': "🇺🇸 English"
@@ -29,15 +218,15 @@ LANGUAGES = {
 
 # --- HTML ШАБЛОН ---
 # Виправлено padding-bottom для правильного розташування часу
+# Стилі спільні для сторінки, параметри кожної цитати - CSS-змінні її контейнера,
+# тому в одну сторінку можна покласти кілька цитат (пакетний рендер)
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html>
 <head>
 <meta charset="UTF-8">
-<link href="https://fonts.googleapis.com/css2?family=Roboto:wght@400;500;700&display=swap" rel="stylesheet">
-<link href="https://fonts.googleapis.com/css2?family=Noto+Color+Emoji&display=swap" rel="stylesheet">
-
 <style>
+    {font_faces}
     body {{
         width: 512px;
         background-color: transparent;
@@ -69,8 +258,8 @@ HTML_TEMPLATE = """
         font-family: 'Roboto', sans-serif;
         text-transform: uppercase;
         
-        background: {avatar_bg}; 
-        background-color: {fallback_color};
+        background: var(--avatar-bg); 
+        background-color: var(--fallback-color);
         background-size: cover;
         background-position: center;
         background-repeat: no-repeat;
@@ -80,12 +269,12 @@ HTML_TEMPLATE = """
         box-shadow: 0 4px 8px rgba(0,0,0,0.25);
     }}
     .bubble {{
-        background-color: {bubble_bg};
-        color: {text_color};
+        background-color: var(--bubble-bg);
+        color: var(--text-color);
         padding: 22px 28px 28px 28px;
         border-radius: 35px 35px 35px 10px;
         position: relative;
-        max-width: {bubble_max_width}px; 
+        max-width: var(--bubble-max-width); 
         min-width: 140px;
         width: auto;
         box-shadow: 0 1px 2px rgba(0,0,0,0.15), 0 4px 12px rgba(0,0,0,0.1); 
@@ -93,9 +282,9 @@ HTML_TEMPLATE = """
         display: table;
     }}
     .name {{
-        color: {name_color};
+        color: var(--name-color);
         font-weight: 700;
-        font-size: {name_size}px; 
+        font-size: var(--name-size); 
         line-height: 1.2;
         margin-bottom: 8px;
         display: block;
@@ -110,9 +299,9 @@ HTML_TEMPLATE = """
         margin-top: 5px;
     }}
     .text {{
-        color: {text_color} !important; 
+        color: var(--text-color) !important; 
         font-weight: 400;
-        font-size: {text_size}px; 
+        font-size: var(--text-size); 
         line-height: 1.4;
         word-wrap: break-word;
         word-break: break-word;
@@ -126,7 +315,21 @@ HTML_TEMPLATE = """
 </style>
 </head>
 <body>
-    <div class="message-container">
+{messages}
+</body>
+</html>
+"""
+
+# CSS-змінні однієї цитати (атрибут style її контейнера)
+MESSAGE_STYLE = (
+    "--avatar-bg: {avatar_bg}; --fallback-color: {fallback_color}; "
+    "--bubble-bg: {bubble_bg}; --text-color: {text_color}; --bubble-max-width: {bubble_max_width}px; "
+    "--name-color: {name_color}; --name-size: {name_size}px; --text-size: {text_size}px;"
+)
+
+# Одна цитата (підставляється в {messages})
+MESSAGE_TEMPLATE = """
+    <div class="message-container" style="{style}">
         <div class="avatar">{avatar_text}</div>
         <div class="bubble">
             <span class="name">{name}</span>
@@ -134,6 +337,4 @@ HTML_TEMPLATE = """
             <div class="text">{text}</div>
         </div>
     </div>
-</body>
-</html>
 """
\ No newline at end of file
@@ -2,10 +2,12 @@ import asyncio
 import logging
 import os
 import random
+import signal
 from aiohttp import web
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.types import (
-    Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+    Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery,
+    InlineQuery, InlineQueryResultCachedSticker, InlineQueryResultsButton
 )
 from aiogram.filters import StateFilter, Command
 from aiogram.fsm.context import FSMContext
@@ -13,10 +15,25 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.exceptions import TelegramBadRequest
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
-from config import BOT_TOKEN, LANGUAGES, COLOR_KEY_TO_ID
+from config import (
+    BOT_TOKEN, LANGUAGES, COLOR_KEY_TO_ID, RENDER_WORKERS,
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET,
+    INLINE_STORAGE_CHAT_ID, INLINE_DEBOUNCE_MS, INLINE_BUDGET_S, INLINE_CACHE_TIME
+)
 from texts import MESSAGES
-from utils import download_avatar, render_sticker, delete_message_safe, startup_browser, shutdown_browser
+from storage import create_storage
+from metrics import render_metrics
+from middlewares import (
+    HandlerMetricsMiddleware, BotApiMetricsMiddleware, ThrottlingMiddleware, OutboundLimiterMiddleware
+)
+from utils import (
+    download_avatar, render_sticker, render_sticker_file_id, delete_message_safe, startup_browser, shutdown_browser,
+    render_queue, RenderQueueFull, Deadline, start_render_workers, stop_render_workers,
+    startup_http, shutdown_http, blob_store, image_executor, run_browser_supervisor,
+    deletion_scheduler
+)
 
 class QuoteState(StatesGroup):
     waiting_for_initial_text = State()
@@ -31,27 +48,59 @@ class QuoteState(StatesGroup):
     pref_theme = State() 
     pref_default_color = State()
     is_custom_avatar = State() 
-    content_image = State() 
+    content_image_key = State() 
     quote_text = State()
     quote_name = State()
     quote_color_key = State()
-    avatar_base64 = State()
+    avatar_key = State()
     original_uid = State()
 
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+storage = create_storage()
+dp = Dispatcher(storage=storage)
 router = Router()
 dp.include_router(router)
+# Одне сховище відер на всі типи подій, щоб ліміт користувача був спільним
+throttling = ThrottlingMiddleware()
+for observer in (router.message, router.callback_query, router.inline_query):
+    observer.middleware(throttling)
+    observer.middleware(HandlerMetricsMiddleware())
+# Перший зареєстрований - зовнішній: лічильник бачить лише виклики, які реально пішли в Telegram
+bot.session.middleware(OutboundLimiterMiddleware())
+bot.session.middleware(BotApiMetricsMiddleware())
 
 async def health_check(request): return web.Response(text="OK")
+async def metrics_handler(request): return web.Response(text=render_metrics(), content_type="text/plain")
 async def start_web_server():
     app = web.Application()
     app.router.add_get('/', health_check)
+    app.router.add_get('/metrics', metrics_handler)
+    if WEBHOOK_URL:
+        # Оновлення від Telegram приймаються тут же; запити без правильного секрету відхиляються
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+        # Без polling хуки диспетчера (startup/shutdown, закриття FSM-сховища) запускає сам застосунок
+        setup_application(app, dp, bot=bot)
     runner = web.AppRunner(app)
     await runner.setup()
     port = int(os.environ.get("PORT", 8080))
     site = web.TCPSite(runner, '0.0.0.0', port)
     await site.start()
+    return runner
+
+def release_session_blobs(data):
+    """Звільняє зображення сесії у сховищі"""
+    blob_store.release(data.get('avatar_key'), data.get('content_image_key'))
+
+async def drop_lost_blobs(state: FSMContext, data):
+    """Прибирає з сесії ключі зображень, яких уже немає у сховищі. True - якщо щось втрачено"""
+    lost = {key: None for key in ('avatar_key', 'content_image_key') if data.get(key) and not blob_store.has(data[key])}
+    if not lost:
+        return False
+    if 'avatar_key' in lost:
+        lost['is_custom_avatar'] = False
+    data.update(lost)
+    await state.update_data(**lost)
+    return True
 
 def get_text(lang_code, key):
     lang_code = lang_code if lang_code in MESSAGES else 'ua'
@@ -147,9 +196,10 @@ async def cmd_start(message: Message, state: FSMContext):
     data = await state.get_data()
     theme = data.get('pref_theme', 'dark')
     def_color = data.get('pref_default_color', None)
+    release_session_blobs(data)
     await state.clear()
     await state.update_data(pref_theme=theme, pref_default_color=def_color)
-    await delete_message_safe(bot, message.chat.id, message.message_id)
+    delete_message_safe(bot, message.chat.id, message.message_id)
     await message.answer("👋 <b>Welcome! / Привіт!</b>\n\n🇺🇦 Будь ласка, обери мову:", reply_markup=get_start_lang_keyboard())
 
 @router.message(Command("cancel", "c"))
@@ -163,8 +213,7 @@ async def cmd_cancel(message: Message, state: FSMContext):
     # Якщо користувач не в процесі створення цитати
     if current_state is None:
         msg = await message.answer(get_text(lang, 'error_nothing_to_cancel'))
-        await asyncio.sleep(2)
-        await delete_message_safe(bot, message.chat.id, msg.message_id)
+        delete_message_safe(bot, message.chat.id, msg.message_id, delay=2)
         return
     
     theme = data.get('pref_theme', 'dark')
@@ -173,16 +222,16 @@ async def cmd_cancel(message: Message, state: FSMContext):
     # Видаляємо останнє повідомлення бота (інлайн меню)
     last_msg_id = data.get('last_bot_msg_id')
     if last_msg_id:
-        await delete_message_safe(bot, message.chat.id, last_msg_id)
+        delete_message_safe(bot, message.chat.id, last_msg_id)
     
     # Очищаємо стан, зберігаючи налаштування
+    release_session_blobs(data)
     await state.clear()
     await state.update_data(lang=lang, pref_theme=theme, pref_default_color=def_color)
     
     # Показуємо повідомлення про скасування
     msg = await message.answer(get_text(lang, 'msg_quote_canceled'))
-    await asyncio.sleep(2)
-    await delete_message_safe(bot, message.chat.id, msg.message_id)
+    delete_message_safe(bot, message.chat.id, msg.message_id, delay=2)
 
 @router.callback_query(F.data.startswith("start_lang_"))
 async def cb_start_lang(callback: CallbackQuery, state: FSMContext):
@@ -297,7 +346,7 @@ async def cb_set_theme(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "delete_msg")
 async def cb_delete_msg(callback: CallbackQuery): await callback.message.delete()
 
-@router.message(Command("q", "create"))
+@router.message(Command("q", "create"), flags={"throttle": "render"})
 async def cmd_create_demo(message: Message, state: FSMContext):
     await bot.send_chat_action(message.chat.id, action="typing")
     
@@ -307,20 +356,24 @@ async def cmd_create_demo(message: Message, state: FSMContext):
     demo_color = random.choice(list(COLOR_KEY_TO_ID.keys()))
     demo_text = get_text(lang, 'demo_text')
     demo_name = message.from_user.full_name
-    avatar_base64 = await download_avatar(bot, user_id=message.from_user.id)
+    avatar_key = blob_store.put(await download_avatar(bot, user_id=message.from_user.id, deadline=Deadline()))
+    # /q може перезапустити активну сесію - звільняємо її зображення
+    release_session_blobs(data)
     await state.update_data(
         quote_text=demo_text, quote_name=demo_name, quote_color_key=demo_color, 
-        avatar_base64=avatar_base64, is_custom_avatar=False, content_image=None, 
+        avatar_key=avatar_key, is_custom_avatar=False, content_image_key=None, 
         pref_theme=theme, last_bot_msg_id=None,
         original_uid=message.from_user.id 
     )
     await show_menu(message, state, is_new=True)
 
-@router.message(F.forward_date | F.text | F.photo | F.caption, StateFilter(None))
+@router.message(F.forward_date | F.text | F.photo | F.caption, StateFilter(None), flags={"throttle": "render"})
 async def handle_content(message: Message, state: FSMContext):
     if message.text and message.text.startswith("/"): return
     
     await bot.send_chat_action(message.chat.id, action="typing")
+    # Обидва завантаження (фото і аватарка) ділять один дедлайн
+    deadline = Deadline()
     
     data = await state.get_data()
     lang = data.get('lang', 'ua')
@@ -329,12 +382,10 @@ async def handle_content(message: Message, state: FSMContext):
     text = message.text or message.caption or ""
     content_img = None
     if message.photo:
-        file_id = message.photo[-1].file_id
-        content_img = await download_avatar(bot, file_id=file_id) 
+        content_img = await download_avatar(bot, photo=message.photo, content=True, deadline=deadline) 
     if not text and not content_img:
         msg = await message.answer(get_text(lang, 'error_no_text'))
-        await asyncio.sleep(2)
-        await delete_message_safe(bot, message.chat.id, msg.message_id)
+        delete_message_safe(bot, message.chat.id, msg.message_id, delay=2)
         return
     name = "Unknown"; uid_color = 0; uid_ava = 0
     if message.forward_from:
@@ -349,7 +400,7 @@ async def handle_content(message: Message, state: FSMContext):
     final_color_key = def_color if def_color else uid_color
     await state.update_data(
         quote_text=text, quote_name=name, quote_color_key=final_color_key, 
-        avatar_base64=await download_avatar(bot, user_id=uid_ava), content_image=content_img, 
+        avatar_key=blob_store.put(await download_avatar(bot, user_id=uid_ava, deadline=deadline)), content_image_key=blob_store.put(content_img), 
         is_custom_avatar=False, lang=lang, pref_theme=theme, pref_default_color=def_color,
         original_uid=uid_color 
     )
@@ -359,6 +410,7 @@ async def show_menu(message: Message, state: FSMContext, is_new=False):
     data = await state.get_data()
     lang = data.get('lang', 'ua')
     theme = data.get('pref_theme', 'dark')
+    images_lost = await drop_lost_blobs(state, data)
     text_preview = data.get('quote_text', '')[:50] + "..." if len(data.get('quote_text', '')) > 50 else data.get('quote_text', '')
     
     if isinstance(data['quote_color_key'], int):
@@ -369,9 +421,10 @@ async def show_menu(message: Message, state: FSMContext, is_new=False):
     lang_flag = LANGUAGES.get(lang, lang).split()[0]
     ava_line = ""
     if data.get('is_custom_avatar'): ava_line = f"🖼 <b>{get_text(lang, 'lbl_avatar')}</b>: {get_text(lang, 'ava_custom')}\n"
-    if data.get('content_image'): text_preview = f"{get_text(lang, 'tag_photo')} {text_preview}"
+    if data.get('content_image_key'): text_preview = f"{get_text(lang, 'tag_photo')} {text_preview}"
     theme_label = get_text(lang, f'theme_{theme}_short')
     info_text = get_text(lang, 'menu_header').format(curr_lang=lang_flag, theme=theme_label, text=text_preview, name=data['quote_name'], color=color_display, avatar_line=ava_line)
+    if images_lost: info_text = f"{get_text(lang, 'msg_images_lost')}\n\n{info_text}"
     kb = get_main_keyboard(lang)
     
     if is_new:
@@ -387,24 +440,55 @@ async def show_menu(message: Message, state: FSMContext, is_new=False):
             await state.update_data(last_bot_msg_id=msg.message_id)
     await state.set_state(QuoteState.menu_processing)
 
-@router.callback_query(F.data == "make_quote", QuoteState.menu_processing)
+@router.callback_query(F.data == "make_quote", QuoteState.menu_processing, flags={"throttle": "render"})
 async def cb_make(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     lang = data.get('lang', 'ua')
     theme = data.get('pref_theme', 'dark')
+    chat_id = callback.message.chat.id
+    
+    # Зображення сесії зникли (наприклад, після перезапуску) - показуємо меню без них
+    if await drop_lost_blobs(state, data):
+        await callback.answer(get_text(lang, 'msg_images_lost'), show_alert=True)
+        await show_menu(callback.message, state, is_new=False)
+        return
+    
+    # Черга переповнена - залишаємо меню, щоб можна було спробувати ще раз
+    if render_queue.is_full(callback.from_user.id):
+        await callback.answer(get_text(lang, 'toast_render_busy'), show_alert=True)
+        return
+    
     await callback.answer(get_text(lang, 'toast_generating'), show_alert=False)
     
-    await bot.send_chat_action(callback.message.chat.id, action="choose_sticker")
+    await bot.send_chat_action(chat_id, action="choose_sticker")
     
     await callback.message.delete()
-    await render_sticker(
-        bot, callback.message.chat.id,
-        data.get('quote_text', ''), data['quote_name'], 
-        data['quote_color_key'], data.get('avatar_base64'),
-        data.get('content_image'),
-        theme
-    )
+    
+    queued_msg = None
+    async def notify_queued(position):
+        nonlocal queued_msg
+        queued_msg = await bot.send_message(chat_id, get_text(lang, 'msg_render_queued').format(position=position))
+    
+    # Черга, рендер і відправка мають вкластися в один дедлайн; після нього все скасовується
+    deadline = Deadline()
+    avatar = await blob_store.get(data.get('avatar_key'))
+    content_image = await blob_store.get(data.get('content_image_key'))
+    try:
+        await deadline.run(render_queue.run(lambda: render_sticker(
+            bot, chat_id,
+            data.get('quote_text', ''), data['quote_name'], 
+            data['quote_color_key'], avatar, content_image,
+            theme, deadline=deadline
+        ), on_queued=notify_queued, user=callback.from_user.id))
+    except RenderQueueFull:
+        await bot.send_message(chat_id, get_text(lang, 'toast_render_busy'))
+    except asyncio.TimeoutError:
+        await bot.send_message(chat_id, get_text(lang, 'error_render_timeout'))
+    finally:
+        if queued_msg:
+            delete_message_safe(bot, chat_id, queued_msg.message_id)
     saved_def_color = data.get('pref_default_color')
+    release_session_blobs(data)
     await state.clear()
     await state.update_data(lang=lang, pref_theme=theme, pref_default_color=saved_def_color)
 
@@ -414,6 +498,7 @@ async def cb_cancel_all(callback: CallbackQuery, state: FSMContext):
     lang = data.get('lang', 'ua')
     saved_def_color = data.get('pref_default_color')
     theme = data.get('pref_theme', 'dark')
+    release_session_blobs(data)
     await state.clear()
     await state.update_data(lang=lang, pref_theme=theme, pref_default_color=saved_def_color)
     await callback.message.delete()
@@ -473,14 +558,14 @@ async def cb_pick_color(callback: CallbackQuery, state: FSMContext):
         
     await show_menu(callback.message, state, is_new=False)
 
-@router.message(QuoteState.editing_text, F.text | F.caption | F.photo)
+@router.message(QuoteState.editing_text, F.text | F.caption | F.photo, flags={"throttle": "render"})
 async def process_text_or_photo_edit(message: Message, state: FSMContext):
     data = await state.get_data()
-    await delete_message_safe(bot, message.chat.id, data.get('last_bot_msg_id'))
+    delete_message_safe(bot, message.chat.id, data.get('last_bot_msg_id'))
     if message.photo:
-        file_id = message.photo[-1].file_id
-        content_img = await download_avatar(bot, file_id=file_id)
-        await state.update_data(content_image=content_img)
+        content_img = await download_avatar(bot, photo=message.photo, content=True, deadline=Deadline())
+        blob_store.release(data.get('content_image_key'))
+        await state.update_data(content_image_key=blob_store.put(content_img))
         if message.caption: await state.update_data(quote_text=message.caption)
     elif message.text: await state.update_data(quote_text=message.text)
     await show_menu(message, state, is_new=True)
@@ -488,7 +573,7 @@ async def process_text_or_photo_edit(message: Message, state: FSMContext):
 @router.message(QuoteState.editing_name, F.text)
 async def process_name(message: Message, state: FSMContext):
     data = await state.get_data()
-    await delete_message_safe(bot, message.chat.id, data.get('last_bot_msg_id'))
+    delete_message_safe(bot, message.chat.id, data.get('last_bot_msg_id'))
     await state.update_data(quote_name=message.text)
     await show_menu(message, state, is_new=True)
 
@@ -497,17 +582,17 @@ async def process_wrong_input_name(message: Message, state: FSMContext):
     data = await state.get_data()
     lang = data.get('lang', 'ua')
     msg = await message.answer(get_text(lang, 'error_name_wrong_type'))
-    await asyncio.sleep(4)  # ⬅️ ТУТ МОЖНА ЗМІНИТИ ЧАС (в секундах)
-    await delete_message_safe(bot, message.chat.id, msg.message_id)
+    delete_message_safe(bot, message.chat.id, msg.message_id, delay=4)  # ⬅️ ТУТ МОЖНА ЗМІНИТИ ЧАС (в секундах)
 
-@router.message(QuoteState.editing_avatar, F.photo)
+@router.message(QuoteState.editing_avatar, F.photo, flags={"throttle": "render"})
 async def process_avatar(message: Message, state: FSMContext):
-    file_id = message.photo[-1].file_id
-    await delete_message_safe(bot, message.chat.id, message.message_id) 
+    photo = message.photo
+    delete_message_safe(bot, message.chat.id, message.message_id) 
     data = await state.get_data()
-    await delete_message_safe(bot, message.chat.id, data.get('last_bot_msg_id'))
-    new_ava = await download_avatar(bot, file_id=file_id)
-    await state.update_data(avatar_base64=new_ava, is_custom_avatar=True)
+    delete_message_safe(bot, message.chat.id, data.get('last_bot_msg_id'))
+    new_ava = await download_avatar(bot, photo=photo, deadline=Deadline())
+    blob_store.release(data.get('avatar_key'))
+    await state.update_data(avatar_key=blob_store.put(new_ava), is_custom_avatar=True)
     await show_menu(message, state, is_new=True)
 
 @router.message(QuoteState.editing_avatar, F.text | F.document)
@@ -515,31 +600,116 @@ async def process_wrong_input_avatar(message: Message, state: FSMContext):
     data = await state.get_data()
     lang = data.get('lang', 'ua')
     msg = await message.answer(get_text(lang, 'error_avatar_wrong_type'))
-    await asyncio.sleep(4)  # ⬅️ ТУТ МОЖНА ЗМІНИТИ ЧАС (в секундах)
-    await delete_message_safe(bot, message.chat.id, msg.message_id)
+    delete_message_safe(bot, message.chat.id, msg.message_id, delay=4)  # ⬅️ ТУТ МОЖНА ЗМІНИТИ ЧАС (в секундах)
 
 @router.message(QuoteState.menu_processing, F.text | F.photo | F.document)
 async def process_wrong_input_main_menu(message: Message, state: FSMContext):
     data = await state.get_data()
     lang = data.get('lang', 'ua')
     msg = await message.answer(get_text(lang, 'error_menu_deleted'))
-    await asyncio.sleep(4)  # ⬅️ ТУТ МОЖНА ЗМІНИТИ ЧАС (в секундах)
-    await delete_message_safe(bot, message.chat.id, msg.message_id)
+    delete_message_safe(bot, message.chat.id, msg.message_id, delay=4)  # ⬅️ ТУТ МОЖНА ЗМІНИТИ ЧАС (в секундах)
 
 @router.message(QuoteState.editing_color, F.text | F.photo | F.document)
 async def process_wrong_input_color_menu(message: Message, state: FSMContext):
     data = await state.get_data()
     lang = data.get('lang', 'ua')
     msg = await message.answer(get_text(lang, 'error_color_menu_deleted'))
-    await asyncio.sleep(4)  # ⬅️ ТУТ МОЖНА ЗМІНИТИ ЧАС (в секундах)
-    await delete_message_safe(bot, message.chat.id, msg.message_id)
+    delete_message_safe(bot, message.chat.id, msg.message_id, delay=4)  # ⬅️ ТУТ МОЖНА ЗМІНИТИ ЧАС (в секундах)
+
+# --- INLINE-РЕЖИМ ---
+# Поточний рендер кожного користувача: новий запит (наступна літера) скасовує попередній
+inline_tasks = {}
+
+async def render_inline(query: InlineQuery, data, deadline):
+    # Чекаємо, поки користувач допише - наступна літера скасує цю задачу ще до рендеру
+    await asyncio.sleep(INLINE_DEBOUNCE_MS / 1000)
+    user = query.from_user
+    color_key = data.get('pref_default_color') or user.id
+    avatar = await download_avatar(bot, user_id=user.id, deadline=deadline)
+    return await render_queue.run(lambda: render_sticker_file_id(
+        bot, INLINE_STORAGE_CHAT_ID, query.query.strip(), user.full_name,
+        color_key, avatar, data.get('pref_theme', 'dark'), deadline=deadline
+    ), user=user.id)
+
+# Свій дебаунс і скасування вже тримають один рендер на користувача
+@router.inline_query(flags={"throttle": "off"})
+async def inline_quote(query: InlineQuery, state: FSMContext):
+    data = await state.get_data()
+    lang = data.get('lang', 'ua')
+    user_id = query.from_user.id
+    if not query.query.strip() or not INLINE_STORAGE_CHAT_ID:
+        hint = 'inline_hint' if INLINE_STORAGE_CHAT_ID else 'inline_unavailable'
+        await query.answer([], cache_time=0, is_personal=True, button=InlineQueryResultsButton(
+            text=get_text(lang, hint), start_parameter="inline"
+        ))
+        return
+
+    previous = inline_tasks.get(user_id)
+    if previous: previous.cancel()
+    deadline = Deadline(INLINE_BUDGET_S)
+    task = asyncio.create_task(deadline.run(render_inline(query, data, deadline)))
+    inline_tasks[user_id] = task
+    file_id = None
+    try:
+        file_id = await task
+    except asyncio.CancelledError:
+        # Запит застарів - на нього вже ніхто не чекає
+        return
+    except (asyncio.TimeoutError, RenderQueueFull):
+        pass
+    except Exception as e:
+        print(f"Inline render error: {e}")
+    finally:
+        if inline_tasks.get(user_id) is task: del inline_tasks[user_id]
+
+    if not file_id:
+        await query.answer([], cache_time=0, is_personal=True, button=InlineQueryResultsButton(
+            text=get_text(lang, 'inline_failed'), start_parameter="inline"
+        ))
+        return
+    # Аватарка і тема в кожного своя, тому кеш Telegram персональний
+    result = InlineQueryResultCachedSticker(id=file_id[-64:], sticker_file_id=file_id)
+    await query.answer([result], cache_time=INLINE_CACHE_TIME, is_personal=True)
 
 async def main():
     logging.basicConfig(level=logging.INFO)
-    await startup_browser()
-    asyncio.create_task(start_web_server())
-    try: await dp.start_polling(bot)
-    finally: await shutdown_browser()
+    await startup_http()
+    # Фонові цикли: тримаємо посилання, щоб задачі не зібрав GC, і зупиняємо їх при виході
+    background = []
+    if RENDER_WORKERS > 0: await start_render_workers(RENDER_WORKERS)
+    else:
+        await startup_browser()
+        background.append(asyncio.create_task(run_browser_supervisor()))
+    runner = await start_web_server()
+    if hasattr(storage, 'run_expiry'): background.append(asyncio.create_task(storage.run_expiry()))
+    try:
+        if WEBHOOK_URL:
+            # Кожна репліка ставить ту саму адресу - повторний виклик нічого не ламає
+            await bot.set_webhook(
+                WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            # Polling сам ловить SIGTERM/SIGINT, тут чекаємо їх власноруч - інакше docker stop обійде finally
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, stop.set)
+            await stop.wait()
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        for task in background: task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        # Запланованих видалень не чекаємо - видаляємо одразу, поки є сесія бота
+        await deletion_scheduler.flush()
+        # У режимі webhook тут спрацьовує shutdown диспетчера (storage.close)
+        await runner.cleanup()
+        await bot.session.close()
+        await stop_render_workers()
+        await shutdown_browser()
+        await shutdown_http()
+        image_executor.shutdown()
 
 if __name__ == "__main__":
     try: asyncio.run(main())
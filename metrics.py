@@ -0,0 +1,149 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+# Мінімальні метрики у текстовому форматі Prometheus (без зовнішніх залежностей)
+
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def collect(self):
+        return [f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in self._values.items()]
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), fn=None):
+        """fn() повертає число або {значення міток (tuple): число} - значення читається під час збору"""
+        super().__init__(name, help_text, labels)
+        self._values = {}
+        self._fn = fn
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def collect(self):
+        values = self._values
+        if self._fn:
+            try:
+                result = self._fn()
+            except Exception as e:
+                print(f"Metric {self.name} error: {e}")
+                return []
+            values = result if isinstance(result, dict) else {(): result}
+        return [f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in values.items()]
+
+class CounterFunc(Gauge):
+    """Лічильник, значення якого береться з fn() (для лічильників, що вже є в об'єктах)"""
+    kind = "counter"
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._counts = {}
+        self._sums = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] = self._sums.get(key, 0.0) + value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def collect(self):
+        lines = []
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {self._sums[key]}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+def render_metrics():
+    """Усі метрики у текстовому форматі Prometheus"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.header())
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+# --- МЕТРИКИ БОТА ---
+RENDER_STAGE_SECONDS = Histogram(
+    "quoteyou_render_stage_seconds", "Render latency per stage", ["stage"]
+)
+RENDERS_TOTAL = Counter(
+    "quoteyou_renders_total", "Sticker renders by engine and result", ["engine", "result"]
+)
+AVATAR_DOWNLOAD_SECONDS = Histogram(
+    "quoteyou_avatar_download_seconds", "Avatar and photo download latency", ["kind"]
+)
+AVATAR_DOWNLOAD_FAILURES = Counter(
+    "quoteyou_avatar_download_failures_total", "Failed avatar and photo downloads", ["kind"]
+)
+BOT_API_REQUESTS = Counter(
+    "quoteyou_bot_api_requests_total", "Bot API calls per method", ["method", "result"]
+)
+HANDLER_SECONDS = Histogram(
+    "quoteyou_handler_seconds", "Handler latency per router handler", ["handler"]
+)
+BROWSER_RESTARTS = Counter(
+    "quoteyou_browser_restarts_total", "Browser relaunches by reason", ["reason"]
+)
+THROTTLED = Counter(
+    "quoteyou_throttled_total", "Updates dropped by the per-user rate limit", ["kind"]
+)
+OUTBOUND_EVENTS = Counter(
+    "quoteyou_outbound_events_total", "Outbound Bot API calls coalesced, superseded or retried", ["method", "event"]
+)
+OUTBOUND_WAIT_SECONDS = Histogram(
+    "quoteyou_outbound_wait_seconds", "Time outbound calls waited for rate limit tokens"
+)
@@ -0,0 +1,273 @@
+import asyncio
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import CallbackQuery
+
+from config import (
+    THROTTLE_LIMITS, THROTTLE_STORE, THROTTLE_REDIS_URL,
+    OUTBOUND_GLOBAL_LIMIT, OUTBOUND_CHAT_LIMIT, OUTBOUND_GROUP_LIMIT,
+    OUTBOUND_MAX_RETRIES, CHAT_ACTION_INTERVAL, INLINE_STORAGE_CHAT_ID
+)
+from metrics import BOT_API_REQUESTS, HANDLER_SECONDS, THROTTLED, OUTBOUND_EVENTS, OUTBOUND_WAIT_SECONDS
+from texts import MESSAGES
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Міряє час кожного хендлера роутера (inner middleware)"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+class BotApiMetricsMiddleware(BaseRequestMiddleware):
+    """Рахує запити до Bot API за методами"""
+
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", type(method).__name__)
+        try:
+            response = await make_request(bot, method)
+        except Exception:
+            BOT_API_REQUESTS.inc(method=name, result="error")
+            raise
+        BOT_API_REQUESTS.inc(method=name, result="ok")
+        return response
+
+# --- ОБМЕЖЕННЯ ЧАСТОТИ ---
+class MemoryBucketStore:
+    """Відра токенів у пам'яті процесу (одна репліка бота)"""
+
+    def __init__(self, max_keys=100_000):
+        self.max_keys = max_keys
+        self._buckets = {}  # ключ -> (токени, час оновлення)
+
+    async def take(self, key, rate, burst, cost=1):
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._prune(now)
+        return allowed
+
+    def _prune(self, now):
+        # Відро, якого не чіпали годину, давно повне - воно нічим не відрізняється від нового
+        idle = [key for key, (tokens, updated) in self._buckets.items() if now - updated > 3600]
+        for key in idle:
+            del self._buckets[key]
+
+# Атомарне поповнення і списання в Redis: спільні ліміти для кількох реплік
+TAKE_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or burst
+local ts = tonumber(data[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+class RedisBucketStore:
+    """Відра токенів у Redis (потрібен пакет redis)"""
+
+    def __init__(self, url=THROTTLE_REDIS_URL, prefix="quoteyou:throttle:"):
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self._take = self._redis.register_script(TAKE_LUA)
+        self.prefix = prefix
+
+    async def take(self, key, rate, burst, cost=1):
+        try:
+            return bool(await self._take(keys=[self.prefix + key], args=[rate, burst, cost]))
+        except Exception as e:
+            # Redis недоступний - краще пропустити запит, ніж заблокувати всіх
+            print(f"Throttle store error: {e}")
+            return True
+
+def create_bucket_store(kind=THROTTLE_STORE):
+    """Створює сховище відер за назвою з конфігу"""
+    if kind == "memory":
+        return MemoryBucketStore()
+    if kind == "redis":
+        return RedisBucketStore()
+    raise ValueError(f"Unknown throttle store: {kind}")
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Відра токенів на користувача: окремо для дій інтерфейсу і для дорогих (рендер, завантаження фото).
+    Клас хендлера задається прапорцем flags={"throttle": "render"}; без прапорця - "ui", "off" - без обмеження"""
+
+    def __init__(self, store=None, limits=THROTTLE_LIMITS):
+        self.store = store or create_bucket_store()
+        self.limits = limits
+
+    async def __call__(self, handler, event, data):
+        kind = get_flag(data, "throttle", default="ui")
+        user = data.get("event_from_user")
+        if user and kind in self.limits:
+            rate, burst = self.limits[kind]
+            if not await self.store.take(f"{kind}:{user.id}", rate, burst):
+                THROTTLED.inc(kind=kind)
+                # Повідомлення ігноруємо мовчки, а кнопці треба відповісти, щоб зник годинник
+                if isinstance(event, CallbackQuery):
+                    state = data.get("state")
+                    lang = (await state.get_data()).get('lang', 'ua') if state else 'ua'
+                    text = MESSAGES.get(lang, MESSAGES['ua']).get('toast_slow_down')
+                    await event.answer(text, show_alert=False)
+                return None
+        return await handler(event, data)
+
+# --- ВИХІДНІ ЗАПИТИ ДО TELEGRAM ---
+class _Bucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class OutboundLimiterMiddleware(BaseRequestMiddleware):
+    """Тримає вихідні запити в лімітах Telegram: глобальне і per-chat відра, повтор після 429,
+    злиття однакових send_chat_action і відкидання застарілих редагувань меню"""
+
+    # Методи, що рахуються в лімітах (решта, як getFile, йде одразу);
+    # видалення - лише в глобальному, бо чатові ліміти Telegram стосуються повідомлень
+    LIMITED_PREFIXES = ("send", "edit", "copy", "forward", "delete")
+
+    def __init__(self, global_limit=OUTBOUND_GLOBAL_LIMIT, chat_limit=OUTBOUND_CHAT_LIMIT,
+                 group_limit=OUTBOUND_GROUP_LIMIT, max_retries=OUTBOUND_MAX_RETRIES,
+                 exempt_chats=(INLINE_STORAGE_CHAT_ID,)):
+        self.chat_limit = chat_limit
+        # Службові чати (сховище inline-стікерів) без чатового відра: лише глобальне і retry_after.
+        # Інакше груповий ліміт (~20/хв) обмежив би нові inline-стікери для всіх користувачів разом
+        self.exempt_chats = {chat_id for chat_id in exempt_chats if chat_id}
+        self.group_limit = group_limit
+        self.max_retries = max_retries
+        self._global = _Bucket(*global_limit)
+        self._chats = {}
+        self._blocked_until = {}  # чат (None - усі) -> до коли Telegram просив не писати
+        self._chat_actions = {}  # (чат, дія) -> коли востаннє надіслано
+        self._edits = {}  # (чат, повідомлення) -> номер останнього редагування
+        self._locks = {}  # чат -> замок черги, щоб запити в чат ішли в порядку надходження
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10_000:
+                self._prune()
+            # Групи й канали мають від'ємний id і суворіший ліміт
+            limit = self.group_limit if isinstance(chat_id, int) and chat_id < 0 else self.chat_limit
+            bucket = self._chats[chat_id] = _Bucket(*limit)
+        return bucket
+
+    def _prune(self):
+        now = time.monotonic()
+        for chat_id, bucket in list(self._chats.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._chats[chat_id]
+        for chat_id, lock in list(self._locks.items()):
+            if not lock.locked():
+                del self._locks[chat_id]
+        for key, sent in list(self._chat_actions.items()):
+            if now - sent > CHAT_ACTION_INTERVAL:
+                del self._chat_actions[key]
+        for chat_id, until in list(self._blocked_until.items()):
+            if until <= now:
+                del self._blocked_until[chat_id]
+
+    async def _wait_turn(self, chat_id, per_chat=True, is_stale=None):
+        """Чекає, поки і глобальне, і чатове відро матимуть токен, і списує обидва.
+        False - запит застарів (is_stale), поки чекав, і токени не списано"""
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+        async with lock:
+            return await self._take_tokens(chat_id, per_chat, is_stale)
+
+    async def _take_tokens(self, chat_id, per_chat, is_stale):
+        started = time.monotonic()
+        while True:
+            if is_stale and is_stale():
+                return False
+            now = time.monotonic()
+            buckets = [self._global]
+            if per_chat and chat_id is not None:
+                buckets.append(self._chat_bucket(chat_id))
+            wait = max(self._blocked_until.get(None, 0), self._blocked_until.get(chat_id, 0)) - now
+            for bucket in buckets:
+                bucket.refill(now)
+                wait = max(wait, bucket.wait_time())
+            if wait <= 0:
+                for bucket in buckets:
+                    bucket.tokens -= 1
+                OUTBOUND_WAIT_SECONDS.observe(now - started)
+                return True
+            await asyncio.sleep(wait)
+
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", "")
+        chat_id = getattr(method, "chat_id", None)
+
+        if name == "sendChatAction":
+            # Дія показується ~5 секунд, частіше слати її немає сенсу
+            key = (chat_id, method.action)
+            now = time.monotonic()
+            if now - self._chat_actions.get(key, 0) < CHAT_ACTION_INTERVAL:
+                OUTBOUND_EVENTS.inc(method=name, event="coalesced")
+                return True
+            self._chat_actions[key] = now
+            return await make_request(bot, method)
+
+        if not name.startswith(self.LIMITED_PREFIXES):
+            return await make_request(bot, method)
+
+        edit_key = is_stale = None
+        if name == "editMessageText" and chat_id is not None:
+            edit_key = (chat_id, method.message_id)
+            generation = self._edits[edit_key] = self._edits.get(edit_key, 0) + 1
+            # Поки чекали, меню вже змінили ще раз - це редагування застаріло
+            is_stale = lambda: self._edits.get(edit_key) != generation
+
+        try:
+            for attempt in range(self.max_retries + 1):
+                per_chat = not name.startswith("delete") and chat_id not in self.exempt_chats
+                if not await self._wait_turn(chat_id, per_chat, is_stale):
+                    OUTBOUND_EVENTS.inc(method=name, event="superseded")
+                    return True
+                try:
+                    return await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    if attempt == self.max_retries:
+                        raise
+                    # Telegram просить зачекати - усі запити в цей чат (або всі, якщо чату нема) стоять
+                    self._blocked_until[chat_id] = time.monotonic() + e.retry_after
+                    OUTBOUND_EVENTS.inc(method=name, event="retry_after")
+        finally:
+            if edit_key and self._edits.get(edit_key) == generation:
+                del self._edits[edit_key]
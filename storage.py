@@ -0,0 +1,143 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import FSM_STORAGE, FSM_DB_PATH, FSM_SESSION_TTL, FSM_EXPIRY_INTERVAL
+
+# Ключі, які є налаштуваннями користувача і живуть без TTL.
+# Все інше - дані поточної сесії редактора.
+PREF_KEYS = ('lang', 'pref_theme', 'pref_default_color')
+
+def _dumps(data):
+    # Компактний JSON без пробілів і \u-екранування
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _loads(raw):
+    return json.loads(raw) if raw else {}
+
+def _key(key):
+    return ":".join(str(part) for part in (
+        key.bot_id, key.chat_id, key.user_id,
+        getattr(key, 'thread_id', None), getattr(key, 'business_connection_id', None),
+        key.destiny
+    ))
+
+class SQLiteStorage(BaseStorage):
+    """FSM у SQLite: налаштування зберігаються назавжди, сесії видаляються після TTL.
+    Запити йдуть в одному окремому потоці, щоб диск не блокував цикл подій"""
+
+    def __init__(self, path=FSM_DB_PATH, session_ttl=FSM_SESSION_TTL):
+        self.session_ttl = session_ttl
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Один потік: запити виконуються по черзі, читання-зміна-запис не перемішуються
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm-sqlite")
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS prefs (key TEXT PRIMARY KEY, data BLOB NOT NULL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "key TEXT PRIMARY KEY, state TEXT, data BLOB, updated_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+        self._db.commit()
+        self.expired = 0
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _session(self, k):
+        row = self._db.execute("SELECT state, data, updated_at FROM sessions WHERE key = ?", (k,)).fetchone()
+        if row is None:
+            return None, {}
+        if time.time() - row[2] > self.session_ttl:
+            self._db.execute("DELETE FROM sessions WHERE key = ?", (k,))
+            self._db.commit()
+            self.expired += 1
+            return None, {}
+        return row[0], _loads(row[1])
+
+    def _save_session(self, k, state, data):
+        if state is None and not data:
+            self._db.execute("DELETE FROM sessions WHERE key = ?", (k,))
+        else:
+            self._db.execute(
+                "INSERT INTO sessions (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                "updated_at = excluded.updated_at",
+                (k, state, _dumps(data) if data else None, time.time())
+            )
+        self._db.commit()
+
+    def _set_state(self, k, state):
+        _, data = self._session(k)
+        self._save_session(k, state, data)
+
+    def _set_data(self, k, data):
+        prefs = {name: data[name] for name in PREF_KEYS if name in data}
+        session = {name: value for name, value in data.items() if name not in PREF_KEYS}
+        if prefs:
+            self._db.execute(
+                "INSERT INTO prefs (key, data) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+                (k, _dumps(prefs))
+            )
+        else:
+            self._db.execute("DELETE FROM prefs WHERE key = ?", (k,))
+        state, _ = self._session(k)
+        self._save_session(k, state, session)
+
+    def _get_data(self, k):
+        row = self._db.execute("SELECT data FROM prefs WHERE key = ?", (k,)).fetchone()
+        data = _loads(row[0]) if row else {}
+        _, session = self._session(k)
+        data.update(session)
+        return data
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        await self._run(self._set_state, _key(key), state)
+
+    async def get_state(self, key):
+        state, _ = await self._run(self._session, _key(key))
+        return state
+
+    async def set_data(self, key, data):
+        await self._run(self._set_data, _key(key), data)
+
+    async def get_data(self, key):
+        return await self._run(self._get_data, _key(key))
+
+    def expire_sessions(self):
+        """Видаляє всі сесії, неактивні довше за TTL"""
+        cursor = self._db.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.session_ttl,))
+        self._db.commit()
+        self.expired += cursor.rowcount
+        return cursor.rowcount
+
+    async def run_expiry(self, interval=FSM_EXPIRY_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try: await self._run(self.expire_sessions)
+            except Exception as e: print(f"Session expiry error: {e}")
+
+    async def close(self):
+        await self._run(self._db.close)
+        self._executor.shutdown()
+
+def create_storage(kind=FSM_STORAGE):
+    """Створює сховище FSM за назвою з конфігу"""
+    if kind == "sqlite":
+        return SQLiteStorage()
+    if kind == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown FSM storage: {kind}")
@@ -65,6 +65,14 @@ MESSAGES = {
         'toast_canceled': "✅ Редагування скасовано",
         'toast_generating': "🎨 Створюю стікер...",
         'toast_auto_color': "🎲 Встановлено авто-колір!",
+        'toast_render_busy': "⏳ Бот зараз перевантажений, спробуй ще раз за хвилинку.",
+        'msg_render_queued': "⏳ Багато запитів, твоя позиція в черзі: <b>{position}</b>",
+        'error_render_timeout': "⌛ Не вдалося створити стікер вчасно, спробуй ще раз.",
+        'msg_images_lost': "⚠️ Фото або аватарка цієї цитати більше не збережені, додай їх ще раз.",
+        'toast_slow_down': "🐢 Забагато запитів, зачекай трохи",
+        'inline_hint': "✍️ Напиши текст цитати",
+        'inline_unavailable': "Inline-режим вимкнено, відкрий бота",
+        'inline_failed': "⏳ Не встиг, спробуй ще раз",
         
         'msg_quote_canceled': "✅ Створення цитати cкасовано",
         'error_nothing_to_cancel': "ℹ️ Немає активної цитати для скасування.",
@@ -186,6 +194,14 @@ MESSAGES = {
         'toast_canceled': "✅ Edit canceled",
         'toast_generating': "🎨 Creating sticker...",
         'toast_auto_color': "🎲 Auto color set!",
+        'toast_render_busy': "⏳ The bot is overloaded right now, try again in a minute.",
+        'msg_render_queued': "⏳ Lots of requests, your position in queue: <b>{position}</b>",
+        'error_render_timeout': "⌛ Couldn't make the sticker in time, please try again.",
+        'msg_images_lost': "⚠️ The photo or avatar of this quote is no longer stored, please add it again.",
+        'toast_slow_down': "🐢 Too many requests, slow down a bit",
+        'inline_hint': "✍️ Type the quote text",
+        'inline_unavailable': "Inline mode is off, open the bot",
+        'inline_failed': "⏳ Too slow, try again",
         
         'msg_quote_canceled': "✅ Quote creation canceled",
         'error_nothing_to_cancel': "ℹ️ No active quote to cancel.",
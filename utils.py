@@ -1,51 +1,970 @@
+import asyncio
+import atexit
 import base64
+import collections
+import functools
+import hashlib
+import heapq
 import io
+import itertools
+import multiprocessing
+import os
+import re
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import aiohttp
 from playwright.async_api import async_playwright
-from PIL import Image
+from PIL import Image, ImageColor, ImageDraw, ImageFilter, ImageFont, ImageOps
 
-from config import HTML_TEMPLATE, TELEGRAM_COLORS, COLOR_KEY_TO_ID
+from metrics import (
+    Gauge, CounterFunc, BROWSER_RESTARTS, RENDER_STAGE_SECONDS, RENDERS_TOTAL, AVATAR_DOWNLOAD_SECONDS, AVATAR_DOWNLOAD_FAILURES
+)
+from config import (
+    HTML_TEMPLATE, MESSAGE_TEMPLATE, MESSAGE_STYLE, TELEGRAM_COLORS, COLOR_KEY_TO_ID, PAGE_POOL_MIN, PAGE_POOL_MAX,
+    RENDER_MAX_IN_FLIGHT, RENDER_MAX_QUEUE, RENDER_MAX_QUEUE_PER_USER, RENDER_WORKERS, RENDER_ENGINE,
+    RENDER_QUALITY, RENDER_QUALITY_PROFILES, RENDER_READY_TIMEOUT_MS,
+    RENDER_DEADLINE_S, PAGE_OP_TIMEOUT_MS, PAGE_RESET_TIMEOUT_S, DELETE_BATCH_WINDOW_MS, DELETE_RATE, RENDER_MODE, RENDER_BATCH_WINDOW_MS, RENDER_BATCH_MAX, IMAGE_EXECUTOR, IMAGE_WORKERS,
+    STICKER_CACHE_SIZE, STICKER_CACHE_TTL, TEMPLATE_VERSION,
+    AVATAR_CACHE_SIZE, AVATAR_CACHE_TTL, AVATAR_CACHE_NEGATIVE_TTL,
+    HTTP_POOL_LIMIT, HTTP_LIMIT_PER_HOST, HTTP_KEEPALIVE, HTTP_TIMEOUT, HTTP_CONNECT_TIMEOUT,
+    BLOB_MEMORY_LIMIT, BLOB_DISK_DIR, BLOB_TTL,
+    AVATAR_TARGET_PX, CONTENT_IMAGE_TARGET_PX, MAX_DOWNLOAD_BYTES,
+    BROWSER_RECYCLE_RENDERS, BROWSER_RECYCLE_RSS_MB, BROWSER_CHECK_INTERVAL,
+    BROWSER_PROBE_TIMEOUT, BROWSER_DRAIN_TIMEOUT,
+    FONTS_DIR, FONT_BASE_URL, FONT_SYSTEM_DIRS, FONT_FILES, FONT_LOCAL_NAMES, EMOJI_FONT_LOCAL_NAMES
+)
 
 # Глобальний браузер
 browser = None
+playwright = None
+# Пули прогрітих сторінок: масштаб сторінки -> PagePool
+page_pools = {}
+
+class PagePool:
+    """Обмежений пул прогрітих сторінок, кожна у власному контексті браузера"""
+
+    def __init__(self, browser, scale=3.0, min_size=PAGE_POOL_MIN, max_size=PAGE_POOL_MAX):
+        self.browser = browser
+        self.scale = scale
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, self.min_size, max_size)
+        self._idle = []
+        self._waiters = collections.deque()
+        self._size = 0  # усі створені сторінки (вільні + видані)
+        # Пул старого браузера: нові сторінки не видаються, повернені закриваються
+        self.retired = False
+        self.drained = asyncio.Event()
+        # Лічильники
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    async def _new_page(self):
+        # device_scale_factor з профілю якості (3.0 для "max") + збільшений viewport
+        context = await self.browser.new_context(
+            viewport={'width': 512, 'height': 2000},
+            device_scale_factor=self.scale
+        )
+        try:
+            page = await context.new_page()
+        except BaseException:
+            await context.close()
+            raise
+        # Одна операція Playwright не може забрати весь дедлайн рендеру
+        page.set_default_timeout(PAGE_OP_TIMEOUT_MS)
+        # Шрифти з папки проєкту віддаються з пам'яті, HTML лише посилається на них
+        await page.route(FONT_BASE_URL + "*", _serve_font)
+        return page
+
+    async def _grow(self):
+        self._size += 1
+        try:
+            return await self._new_page()
+        except BaseException:
+            self._size -= 1
+            raise
+
+    async def warm_up(self):
+        """Створює мінімальну кількість сторінок заздалегідь"""
+        while self._size < self.min_size:
+            self._idle.append(await self._grow())
+
+    async def acquire(self):
+        """Видає вільну сторінку, створює нову або чекає, поки якась звільниться"""
+        if self._idle:
+            self.hits += 1
+            return self._idle.pop()
+        if self._size < self.max_size:
+            self.misses += 1
+            return await self._grow()
+
+        self.waits += 1
+        started = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            page = await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Сторінку вже встигли передати - повертаємо її в пул
+                self._put(waiter.result())
+            else:
+                try: self._waiters.remove(waiter)
+                except ValueError: pass
+            raise
+        finally:
+            self.wait_time += time.monotonic() - started
+        if page is None:
+            # Попередня сторінка зламалась - створюємо заміну
+            self.misses += 1
+            return await self._grow()
+        return page
+
+    def _put(self, page):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(page)
+                return
+        if page is None:
+            return
+        self._idle.append(page)
+
+    async def release(self, page):
+        """Скидає стан сторінки і повертає її в пул"""
+        if self.retired and not self._waiters:
+            await self._discard(page)
+            return
+        try:
+            if RENDER_MODE == "patch":
+                # Шаблон лишається завантаженим для наступного рендеру
+                reset = page.evaluate(PATCH_CLEAR_JS)
+            else:
+                reset = page.goto("about:blank")
+            # Завислу сторінку не повертаємо - вона тримала б слот пулу назавжди
+            await asyncio.wait_for(reset, PAGE_RESET_TIMEOUT_S)
+        except BaseException as e:
+            print(f"Page reset error: {e!r}")
+            # Чекаючий отримає None і створить собі нову сторінку
+            if self._waiters:
+                self._put(None)
+            await self._discard(page)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+        self._put(page)
+
+    async def _discard(self, page):
+        self._size -= 1
+        try: await page.context.close()
+        except Exception: pass
+        if self.retired and self._size <= 0:
+            self.drained.set()
+
+    async def retire(self):
+        """Закриває вільні сторінки; drained спрацює, коли повернуться всі видані"""
+        self.retired = True
+        idle, self._idle = self._idle, []
+        for page in idle:
+            await self._discard(page)
+        if self._size <= 0:
+            self.drained.set()
+
+    async def close(self):
+        for page in self._idle:
+            try: await page.context.close()
+            except Exception: pass
+        self._idle.clear()
+        self._size = 0
+
+    def stats(self):
+        return {
+            "size": self._size,
+            "idle": len(self._idle),
+            "waiting": len(self._waiters),
+            "hits": self.hits,
+            "misses": self.misses,
+            "waits": self.waits,
+            "wait_time": self.wait_time,
+        }
+
+class RenderQueueFull(Exception):
+    """Черга рендеру заповнена"""
+
+class RenderQueue:
+    """Обмежує кількість одночасних рендерів; черга очікування обслуговує користувачів по колу"""
+
+    def __init__(self, max_in_flight=RENDER_MAX_IN_FLIGHT, max_queue=RENDER_MAX_QUEUE,
+                 max_queue_per_user=RENDER_MAX_QUEUE_PER_USER):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(0, max_queue)
+        self.max_queue_per_user = max(1, max_queue_per_user)
+        self.in_flight = 0
+        # користувач -> його черга; порядок ключів - черговість обслуговування
+        self._queues = collections.OrderedDict()
+        self._queued = 0
+        self.rejected = 0
+
+    def is_full(self, user=None):
+        if self.in_flight < self.max_in_flight and not self._queued:
+            return False
+        return self._queued >= self.max_queue or len(self._queues.get(user, ())) >= self.max_queue_per_user
+
+    def position(self, user):
+        """Приблизна позиція останнього запиту користувача з урахуванням черги по колу"""
+        own = len(self._queues.get(user, ()))
+        return own + sum(min(len(waiters), own) for key, waiters in self._queues.items() if key != user)
+
+    async def run(self, job, on_queued=None, user=None):
+        """Виконує job() коли звільниться слот. on_queued(position) викликається, якщо доводиться чекати"""
+        if self.in_flight < self.max_in_flight and not self._queued:
+            self.in_flight += 1
+        else:
+            if self.is_full(user):
+                self.rejected += 1
+                raise RenderQueueFull()
+            waiter = asyncio.get_running_loop().create_future()
+            self._queues.setdefault(user, collections.deque()).append(waiter)
+            self._queued += 1
+            try:
+                if on_queued:
+                    # Повідомлення про чергу - не головне: його збій не скасовує рендер
+                    try: await on_queued(self.position(user))
+                    except Exception as e: print(f"Queue notice error: {e}")
+                # Слот передається разом з результатом, in_flight вже враховано
+                await waiter
+            except BaseException:
+                # Будь-який вихід без рендеру: отриманий слот повертаємо, інакше виходимо з черги
+                if waiter.done() and not waiter.cancelled():
+                    self._release()
+                else:
+                    self._remove(user, waiter)
+                raise
+        try:
+            return await job()
+        finally:
+            self._release()
+
+    def _remove(self, user, waiter):
+        waiters = self._queues.get(user)
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        self._queued -= 1
+        if not waiters:
+            del self._queues[user]
+
+    def _release(self):
+        while self._queues:
+            # Перший у колі користувач отримує слот і переходить у кінець кола
+            user, waiters = next(iter(self._queues.items()))
+            waiter = waiters.popleft()
+            self._queued -= 1
+            if waiters:
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "queued": self._queued,
+            "users_queued": len(self._queues),
+            "rejected": self.rejected,
+        }
+
+# Глобальна черга рендеру
+render_queue = RenderQueue()
+
+class Deadline:
+    """Спільний дедлайн запиту: кожен етап (завантаження, черга, рендер, відправка) отримує лише залишок часу"""
+
+    def __init__(self, seconds=RENDER_DEADLINE_S):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    async def run(self, awaitable):
+        """Як asyncio.wait_for: після дедлайну скасовує awaitable і кидає asyncio.TimeoutError"""
+        return await asyncio.wait_for(awaitable, self.remaining())
+
+# --- ПРОЦЕСИ-ВОРКЕРИ РЕНДЕРУ ---
+# Кожен воркер має власний цикл asyncio і власний Chromium,
+# головний процес лише передає параметри і отримує WebP байти
+render_pool = None
+render_pool_size = 0
+_worker_loop = None
+
+def _worker_init():
+    global _worker_loop
+    _worker_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_worker_loop)
+    _worker_loop.run_until_complete(startup_browser())
+    atexit.register(_worker_shutdown)
+
+def _worker_shutdown():
+    try: _worker_loop.run_until_complete(shutdown_browser())
+    except Exception: pass
+
+def _worker_ping():
+    return os.getpid()
+
+def _worker_render_batch(jobs, quality):
+    return _worker_loop.run_until_complete(render_webp_batch(jobs, quality))
+
+async def start_render_workers(workers=RENDER_WORKERS):
+    """Запускає пул процесів, кожен зі своїм браузером"""
+    global render_pool, render_pool_size
+    if render_pool is None and workers > 0:
+        render_pool_size = workers
+        render_pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_worker_init
+        )
+        # Прогріваємо воркери, щоб перший рендер не чекав запуску Chromium
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(render_pool, _worker_ping) for _ in range(workers)])
+
+async def stop_render_workers():
+    global render_pool
+    if render_pool:
+        pool, render_pool = render_pool, None
+        await asyncio.get_running_loop().run_in_executor(None, pool.shutdown)
+
+async def _render_in_worker(fn, *args):
+    global render_pool
+    pool = render_pool
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        # Воркер впав - перезапускаємо пул, щоб наступні рендери працювали
+        if render_pool is pool:
+            render_pool = None
+            pool.shutdown(wait=False)
+            await start_render_workers()
+        raise
+
+# --- ОБРОБКА ЗОБРАЖЕНЬ ---
+class ImageExecutor:
+    """Виконує роботу Pillow у пулі потоків або процесів з обмеженням паралельності"""
+
+    def __init__(self, kind=IMAGE_EXECUTOR, workers=IMAGE_WORKERS):
+        self.kind = kind
+        self.workers = max(1, workers)
+        self._executor = None
+        self._semaphore = asyncio.Semaphore(self.workers)
+        # Метрики
+        self.jobs = 0
+        self.in_flight = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        self.max_run_time = 0.0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image")
+        return self._executor
+
+    async def run(self, fn, *args):
+        queued = time.perf_counter()
+        async with self._semaphore:
+            started = time.perf_counter()
+            self.wait_time += started - queued
+            self.in_flight += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+            finally:
+                elapsed = time.perf_counter() - started
+                self.in_flight -= 1
+                self.jobs += 1
+                self.run_time += elapsed
+                self.max_run_time = max(self.max_run_time, elapsed)
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self):
+        return {
+            "jobs": self.jobs,
+            "in_flight": self.in_flight,
+            "wait_time": self.wait_time,
+            "run_time": self.run_time,
+            "max_run_time": self.max_run_time,
+        }
+
+image_executor = ImageExecutor()
+
+# --- ПРОФІЛІ ЯКОСТІ ---
+def get_quality_profile(quality=None):
+    """Повертає (назва, профіль) з RENDER_QUALITY_PROFILES; невідома назва - профіль за замовчуванням"""
+    name = quality if quality in RENDER_QUALITY_PROFILES else RENDER_QUALITY
+    return name, RENDER_QUALITY_PROFILES[name]
+
+def _resample(profile):
+    return getattr(Image.Resampling, profile["resample"].upper())
+
+def get_page_pool(scale):
+    """Пул сторінок для масштабу; пул профілю за замовчуванням прогрівається при старті"""
+    pool = page_pools.get(scale)
+    if pool is None:
+        pool = page_pools[scale] = PagePool(browser, scale=scale, min_size=0)
+    return pool
+
+# --- ФОНОВІ ЗАДАЧІ ---
+# asyncio тримає на задачі лише слабкі посилання - задачі без власника живуть тут до завершення
+_background_tasks = set()
+
+def spawn(coro):
+    """ensure_future з сильним посиланням; помилка задачі друкується, а не губиться"""
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_done)
+    return task
+
+def _on_background_done(task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        print(f"Background task error: {task.exception()}")
+
+async def _launch_browser():
+    global playwright
+    if playwright is None:
+        playwright = await async_playwright().start()
+    new_browser = await playwright.chromium.launch(headless=True, args=['--no-sandbox', '--disable-setuid-sandbox'])
+    new_browser.on("disconnected", _on_browser_disconnected)
+    return new_browser
+
+def _on_browser_disconnected(old_browser):
+    # Закриті нами браузери вже не поточні - реагуємо лише на падіння поточного
+    if old_browser is browser:
+        print("Browser disconnected, relaunching")
+        spawn(supervisor.restart("crash", expected=old_browser))
+
+# --- НАГЛЯД ЗА БРАУЗЕРОМ ---
+class BrowserSupervisor:
+    """Перезапускає браузер після падіння і періодично замінює його свіжим"""
+
+    def __init__(self, recycle_renders=BROWSER_RECYCLE_RENDERS, recycle_rss_mb=BROWSER_RECYCLE_RSS_MB,
+                 check_interval=BROWSER_CHECK_INTERVAL):
+        self.recycle_renders = recycle_renders
+        self.recycle_rss = recycle_rss_mb * 1024 * 1024
+        self.check_interval = check_interval
+        self.renders = 0  # проходи рендеру поточного браузера
+        self._last_rss_check = 0.0
+        self._lock = asyncio.Lock()
+        self._recycling = False
+
+    async def restart(self, reason, expected=None):
+        """Запускає новий браузер і пули; старий закривається, коли допрацюють видані сторінки"""
+        global browser, page_pools
+        async with self._lock:
+            # Хтось інший уже замінив цей браузер
+            if expected is not browser:
+                return
+            old_browser, old_pools = browser, page_pools
+            new_browser = await _launch_browser()
+            scale = get_quality_profile()[1]["scale"]
+            pools = {scale: PagePool(new_browser, scale=scale)}
+            await pools[scale].warm_up()
+            browser, page_pools = new_browser, pools
+            self.renders = 0
+            if old_browser is not None:
+                BROWSER_RESTARTS.inc(reason=reason)
+                print(f"Browser restarted ({reason})")
+        if old_browser is not None:
+            spawn(self._drain(old_browser, old_pools))
+
+    async def _drain(self, old_browser, old_pools):
+        for pool in old_pools.values():
+            await pool.retire()
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*[pool.drained.wait() for pool in old_pools.values()]), BROWSER_DRAIN_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            print("Browser drain timeout, closing anyway")
+        try: await old_browser.close()
+        except Exception as e: print(f"Old browser close error: {e}")
+
+    def recycle_reason(self):
+        """Причина замінити поточний браузер або None"""
+        if self.recycle_renders and self.renders >= self.recycle_renders:
+            return "renders"
+        if self.recycle_rss and time.monotonic() - self._last_rss_check >= self.check_interval:
+            self._last_rss_check = time.monotonic()
+            # Усе, що запущено з цього процесу, крім нього самого (драйвер Playwright і Chromium)
+            if process_tree_rss() - _self_rss() > self.recycle_rss:
+                return "memory"
+        return None
+
+    def schedule_recycle(self, reason):
+        """Заміна браузера у фоні: рендери тривають на старому, поки запускається новий"""
+        if self._recycling:
+            return
+        self._recycling = True
+        spawn(self._recycle(reason, browser))
+
+    async def _recycle(self, reason, expected):
+        try: await self.restart(reason, expected=expected)
+        except Exception as e: print(f"Browser recycle error: {e}")
+        finally: self._recycling = False
+
+    async def check(self):
+        """Періодична перевірка: браузер відповідає і не перевищує ліміти"""
+        current = browser
+        if current is None:
+            return
+        try:
+            context = await asyncio.wait_for(current.new_context(), BROWSER_PROBE_TIMEOUT)
+            await context.close()
+        except Exception as e:
+            print(f"Browser health check failed: {e}")
+            await self.restart("unresponsive", expected=current)
+            return
+        reason = self.recycle_reason()
+        if reason:
+            self.schedule_recycle(reason)
+
+supervisor = BrowserSupervisor()
+
+async def ensure_browser():
+    """Поточний браузер: запускає, перезапускає після падіння або планує заміну старого"""
+    current = browser
+    if current is None:
+        await supervisor.restart("start", expected=None)
+    elif not current.is_connected():
+        await supervisor.restart("crash", expected=current)
+    else:
+        reason = supervisor.recycle_reason()
+        if reason:
+            supervisor.schedule_recycle(reason)
+
+async def run_browser_supervisor(interval=BROWSER_CHECK_INTERVAL):
+    """Фонова задача головного процесу (воркери перевіряють браузер перед кожним рендером)"""
+    while True:
+        await asyncio.sleep(interval)
+        try: await supervisor.check()
+        except Exception as e: print(f"Browser supervisor error: {e}")
 
 async def startup_browser():
-    global browser
     if browser is None:
-        p = await async_playwright().start()
-        browser = await p.chromium.launch(headless=True, args=['--no-sandbox', '--disable-setuid-sandbox'])
+        await supervisor.restart("start", expected=None)
 
 async def shutdown_browser():
-    global browser
-    if browser:
-        await browser.close()
-        browser = None
+    global browser, page_pools, playwright
+    # Спершу знімаємо поточний браузер, щоб "disconnected" не запустив новий
+    old_browser, browser = browser, None
+    for pool in page_pools.values():
+        await pool.close()
+    page_pools = {}
+    if old_browser:
+        await old_browser.close()
+    if playwright:
+        await playwright.stop()
+        playwright = None
+
+# --- HTTP КЛІЄНТ ---
+# Одна сесія з пулом з'єднань на весь час роботи бота, щоб не платити за TCP+TLS на кожне фото
+http_session = None
+
+async def startup_http():
+    get_http_session()
+
+async def shutdown_http():
+    global http_session
+    if http_session:
+        await http_session.close()
+        http_session = None
+
+def get_http_session():
+    """Повертає спільну сесію (створює її, якщо startup_http ще не викликали)"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE
+        )
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        )
+    return http_session
+
+# --- КЕШ АВАТАРОК ---
+class AvatarCache:
+    """Кеш аватарок: id користувача/чату -> (file_unique_id, байти фото), з негативним кешуванням"""
+
+    def __init__(self, ttl=AVATAR_CACHE_TTL, negative_ttl=AVATAR_CACHE_NEGATIVE_TTL, max_size=AVATAR_CACHE_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._items = collections.OrderedDict()  # uid -> [file_unique_id, data, checked_at]
+        self.hits = 0
+        self.negative_hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def lookup(self, uid):
+        """Повертає (запис, чи свіжий)"""
+        entry = self._items.get(uid)
+        if entry is None:
+            return None, False
+        self._items.move_to_end(uid)
+        ttl = self.ttl if entry[1] else self.negative_ttl
+        return entry, time.monotonic() - entry[2] < ttl
+
+    def put(self, uid, file_unique_id, data):
+        if self.max_size <= 0:
+            return
+        self._items[uid] = [file_unique_id, data, time.monotonic()]
+        self._items.move_to_end(uid)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def touch(self, uid):
+        entry = self._items.get(uid)
+        if entry:
+            entry[2] = time.monotonic()
+
+    def stats(self):
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+        }
+
+avatar_cache = AvatarCache()
+
+class FileTooLarge(Exception):
+    """Файл перевищує MAX_DOWNLOAD_BYTES"""
+
+def pick_photo_size(sizes, target_px, square=True):
+    """Найменший PhotoSize, що покриває target_px (менша сторона для аватарки, ширина для картинки)"""
+    sizes = sorted(sizes, key=lambda p: p.width * p.height)
+    for size in sizes:
+        if (min(size.width, size.height) if square else size.width) >= target_px:
+            return size
+    return sizes[-1]
+
+def normalize_image(data, target_px, square=False):
+    """Декодує фото один раз, зменшує до потрібного розміру і зберігає як JPEG"""
+    image = Image.open(io.BytesIO(data))
+    # Для JPEG декодер одразу видає зменшене зображення - дешевше за повне декодування
+    image.draft("RGB", (target_px, target_px))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if square:
+        # Аватарка: центральний квадрат, як background-size: cover
+        side = min(target_px, *image.size)
+        image = ImageOps.fit(image, (side, side), Image.Resampling.LANCZOS)
+    elif image.width > target_px:
+        # Картинка в повідомленні обмежена лише шириною бульбашки
+        image = image.resize((target_px, max(1, round(image.height * target_px / image.width))), Image.Resampling.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+async def _download_file(bot, file_id, max_bytes=MAX_DOWNLOAD_BYTES):
+    """Потокове завантаження з жорстким обмеженням розміру"""
+    file = await bot.get_file(file_id)
+    if file.file_size and file.file_size > max_bytes:
+        raise FileTooLarge(f"{file.file_size} bytes")
+    url = f"https://api.telegram.org/file/bot{bot.token}/{file.file_path}"
+    async with get_http_session().get(url) as resp:
+        if resp.status != 200:
+            return None
+        if resp.content_length and resp.content_length > max_bytes:
+            raise FileTooLarge(f"{resp.content_length} bytes")
+        chunks = []
+        total = 0
+        async for chunk in resp.content.iter_chunked(64 * 1024):
+            total += len(chunk)
+            if total > max_bytes:
+                raise FileTooLarge(f"more than {max_bytes} bytes")
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+async def _download_photo(bot, file_id, target_px, square=False):
+    data = await _download_file(bot, file_id)
+    if not data:
+        return None
+    return await image_executor.run(normalize_image, data, target_px, square)
+
+async def _download_profile_avatar(bot, user_id):
+    entry, fresh = avatar_cache.lookup(user_id)
+    if fresh:
+        if entry[1]: avatar_cache.hits += 1
+        else: avatar_cache.negative_hits += 1
+        return entry[1]
 
-async def download_avatar(bot, user_id=None, file_id=None):
-    """Завантажує фото і конвертує в base64"""
     try:
-        if file_id:
-            file = await bot.get_file(file_id)
-            file_path = file.file_path
-            url = f"https://api.telegram.org/file/bot{bot.token}/{file_path}"
+        photos = await bot.get_user_profile_photos(user_id, limit=1)
+    except Exception as e:
+        print(f"Error getting profile photos: {e}")
+        from aiogram.exceptions import TelegramBadRequest
+        # Для каналів/чатів фото профілю недоступне - запам'ятовуємо; збої мережі чи API - ні
+        if isinstance(e, TelegramBadRequest):
+            avatar_cache.put(user_id, None, None)
+        return None
+    if not photos.photos:
+        avatar_cache.put(user_id, None, None)
+        return None
+
+    size = pick_photo_size(photos.photos[0], AVATAR_TARGET_PX)
+    # Фото не змінилось - не завантажуємо його знову
+    if entry and entry[1] and entry[0] == size.file_unique_id:
+        avatar_cache.revalidated += 1
+        avatar_cache.touch(user_id)
+        return entry[1]
+
+    avatar_cache.misses += 1
+    data = await _download_photo(bot, size.file_id, AVATAR_TARGET_PX, square=True)
+    if data:
+        avatar_cache.put(user_id, size.file_unique_id, data)
+    return data
+
+async def download_avatar(bot, user_id=None, photo=None, content=False, deadline=None):
+    """Завантажує аватарку або фото з повідомлення (список PhotoSize) і повертає зменшені JPEG байти.
+    content=True - це картинка всередині цитати, а не аватарка. Не встигли до deadline - None"""
+    kind = "content" if content else ("photo" if photo else "profile")
+    started = time.perf_counter()
+    try:
+        if photo:
+            target_px = CONTENT_IMAGE_TARGET_PX if content else AVATAR_TARGET_PX
+            size = pick_photo_size(photo, target_px, square=not content)
+            download = _download_photo(bot, size.file_id, target_px, square=not content)
         elif user_id:
-            photos = await bot.get_user_profile_photos(user_id, limit=1)
-            if not photos.photos:
-                return None
-            file = await bot.get_file(photos.photos[0][-1].file_id)
-            url = f"https://api.telegram.org/file/bot{bot.token}/{file.file_path}"
+            download = _download_profile_avatar(bot, user_id)
         else:
             return None
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    data = await resp.read()
-                    return base64.b64encode(data).decode('utf-8')
+        return await (deadline.run(download) if deadline else download)
     except Exception as e:
         print(f"Error downloading avatar: {e}")
+        AVATAR_DOWNLOAD_FAILURES.inc(kind=kind)
+    finally:
+        AVATAR_DOWNLOAD_SECONDS.observe(time.perf_counter() - started, kind=kind)
     return None
 
+# --- СХОВИЩЕ ЗОБРАЖЕНЬ ---
+class BlobStore:
+    """Зображення за хешем вмісту: диск (якщо задано) + LRU-кеш у пам'яті. У FSM лежать лише ключі.
+    Файлові операції йдуть в одному окремому потоці по черзі, тож читання завжди бачить попередній запис"""
+
+    def __init__(self, memory_limit=BLOB_MEMORY_LIMIT, disk_dir=BLOB_DISK_DIR, ttl=BLOB_TTL):
+        self.memory_limit = memory_limit
+        self.disk_dir = disk_dir or None
+        self.ttl = ttl
+        self._memory = collections.OrderedDict()  # key -> bytes, від найстаршого доступу
+        self._memory_bytes = 0
+        self._disk = collections.OrderedDict()  # key -> розмір файлу
+        self._refs = collections.Counter()
+        # Файли з попереднього запуску: хто на них посилається, невідомо (сесії з SQLite),
+        # тому вони не видаляються при release, а лише за TTL
+        self._restored = set()
+        self._last_used = {}
+        self.evicted = 0
+        self._io = None
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._load_disk_index()
+            self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="blob-disk")
+
+    def _load_disk_index(self):
+        """Підхоплює файли з попереднього запуску, щоб збережені сесії не втратили зображення"""
+        deadline = time.time() - self.ttl
+        for key in os.listdir(self.disk_dir):
+            path = self._path(key)
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime < deadline:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+            self._disk[key] = stat.st_size
+            self._restored.add(key)
+            self._last_used[key] = stat.st_mtime
+
+    def put(self, data):
+        """Зберігає байти і повертає ключ (кожен put - це ще одне посилання на blob)"""
+        if not data:
+            return None
+        key = hashlib.sha256(data).hexdigest()
+        self._refs[key] += 1
+        self._last_used[key] = time.time()
+        # Пишемо на диск одразу (у фоні): сесія в FSM переживає перезапуск, тож і її зображення мають
+        if self.disk_dir and key not in self._disk:
+            self._disk[key] = len(data)
+            self._io.submit(self._write_disk, key, data)
+        self._cache(key, data)
+        self._expire()
+        self._shrink()
+        return key
+
+    async def get(self, key):
+        """Байти за ключем або None, якщо blob уже зник (TTL, перезапуск без диска)"""
+        if not key:
+            return None
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+        elif key in self._disk:
+            data = await asyncio.get_running_loop().run_in_executor(self._io, self._read_disk, key)
+            if data is None:
+                self._remove(key)
+                return None
+            # Поки читали, blob могли звільнити - тоді лише віддаємо байти
+            if key in self._disk:
+                self._cache(key, data)
+                self._shrink()
+        if data is not None and self.has(key):
+            self._last_used[key] = time.time()
+            if key in self._disk:
+                # mtime - час останнього використання для TTL після перезапуску
+                self._io.submit(self._touch_disk, key)
+        return data
+
+    def has(self, key):
+        return key in self._memory or key in self._disk
+
+    def release(self, *keys):
+        """Знімає посилання сесії; blob без посилань видаляється"""
+        for key in keys:
+            if not key or key not in self._refs:
+                continue
+            self._refs[key] -= 1
+            if self._refs[key] <= 0 and key not in self._restored:
+                self._remove(key)
+
+    def _cache(self, key, data):
+        if key not in self._memory:
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+        self._memory.move_to_end(key)
+
+    def _remove(self, key):
+        data = self._memory.pop(key, None)
+        if data is not None:
+            self._memory_bytes -= len(data)
+        self._drop_disk(key)
+        self._refs.pop(key, None)
+        self._restored.discard(key)
+        self._last_used.pop(key, None)
+
+    def _expire(self):
+        """Видаляє blob'и, які не використовувались довше за TTL (покинуті сесії)"""
+        deadline = time.time() - self.ttl
+        for key in [k for k, t in self._last_used.items() if t < deadline]:
+            self._remove(key)
+            self.evicted += 1
+
+    def _shrink(self):
+        while self._memory_bytes > self.memory_limit and len(self._memory) > 1:
+            key, data = self._memory.popitem(last=False)
+            self._memory_bytes -= len(data)
+            if key in self._disk:
+                continue
+            # Без диска blob просто зникає - сесія дізнається про це через has()
+            self._refs.pop(key, None)
+            self._last_used.pop(key, None)
+            self.evicted += 1
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key)
+
+    # --- Виконуються в потоці self._io ---
+    def _write_disk(self, key, data):
+        # Не записалось - наступне читання поверне None, і сесія дізнається про втрату через has()/get()
+        try:
+            with open(self._path(key), "wb") as f:
+                f.write(data)
+        except OSError as e:
+            print(f"Blob disk write error: {e}")
+
+    def _read_disk(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except OSError as e:
+            print(f"Blob disk read error: {e}")
+            return None
+
+    def _touch_disk(self, key):
+        try: os.utime(self._path(key))
+        except OSError: pass
+
+    def _unlink_disk(self, key):
+        try: os.remove(self._path(key))
+        except OSError: pass
+
+    def _drop_disk(self, key):
+        if self._disk.pop(key, None) is not None:
+            self._io.submit(self._unlink_disk, key)
+
+    def stats(self):
+        return {
+            "memory_blobs": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "disk_blobs": len(self._disk),
+            "disk_bytes": sum(self._disk.values()),
+            "evicted": self.evicted,
+        }
+
+blob_store = BlobStore()
+
+# --- ПАМ'ЯТЬ ПРОЦЕСІВ ---
+def _self_rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def process_tree_rss(pid=None):
+    """RSS процесу і всіх його нащадків (Chromium, воркери) у байтах. Лише Linux (/proc)"""
+    pid = pid or os.getpid()
+    children = collections.defaultdict(list)
+    rss = {}
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+            with open(f"/proc/{entry}/statm") as f:
+                resident = int(f.read().split()[1])
+        except OSError:
+            continue
+        # Назва процесу в дужках може містити пробіли - розбираємо після ')'
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children[ppid].append(int(entry))
+        rss[int(entry)] = resident * page_size
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        total += rss.get(current, 0)
+        stack.extend(children.get(current, []))
+    return total
+
 def get_soft_color(color_key_or_id):
     """Отримує м'який колір за ID або ключем"""
     if isinstance(color_key_or_id, str):
@@ -93,106 +1012,857 @@ def calculate_bubble_width(text_length, name_length):
     else:
         return 480  # Максимум для дуже довгих текстів 
 
-async def render_sticker(bot, chat_id, text, name, color_key, avatar_base64=None, content_image_base64=None, theme='dark'):
-    global browser
-    if not browser:
-        await startup_browser()
-
-    # --- ТЕМА ---
+def get_theme_colors(theme):
+    """Повертає (колір бульбашки, колір тексту) для теми"""
     if theme == 'light':
-        bubble_bg = "#ffffff"
-        text_color = "#000000"
+        return "#ffffff", "#000000"
+    return "#212121", "#ffffff"
+
+# --- НАТИВНИЙ РЕНДЕР (Pillow) ---
+# Малює той самий макет, що й HTML_TEMPLATE, без браузера.
+# Усі розміри нижче - CSS пікселі з шаблону.
+CONTAINER_WIDTH = 512
+CONTAINER_PADDING = (10, 10, 60, 15)  # top, right, bottom, left
+CONTAINER_MIN_HEIGHT = 150
+AVATAR_SIZE = 100
+AVATAR_MARGIN_RIGHT = 20
+AVATAR_MARGIN_BOTTOM = 5
+BUBBLE_PADDING = (22, 28, 28, 28)  # top, right, bottom, left
+BUBBLE_BORDER = 1
+BUBBLE_RADIUS = 35
+BUBBLE_TAIL_RADIUS = 10
+BUBBLE_MIN_WIDTH = 140
+NAME_MARGIN_BOTTOM = 8
+
+# Латиниця, кирилиця, грецька та звичайна пунктуація - все, що є в Roboto.
+# Емодзі, RTL і складні писемності лишаємо браузеру. '<' і '&' теж,
+# бо в шаблоні текст інтерпретується як HTML.
+_NATIVE_TEXT_RE = re.compile(r"^[\n\x20-\x25\x27-\x3b\x3d-\x7e\u00a0-\u024f\u0370-\u03ff\u0400-\u052f\u2010-\u2027\u2030-\u205e\u20a0-\u20bf\u2116\u2122]*$")
+
+@functools.lru_cache(maxsize=None)
+def find_font_file(file_name):
+    """Шукає файл шрифту в папці проєкту, потім у системних шрифтах"""
+    for directory in [FONTS_DIR] + FONT_SYSTEM_DIRS:
+        path = os.path.join(directory, file_name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+@functools.lru_cache(maxsize=None)
+def _font_bytes(file_name):
+    """Файл шрифту з папки проєкту (None - немає)"""
+    path = os.path.join(FONTS_DIR, os.path.basename(file_name))
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+async def _serve_font(route):
+    """page.route для FONT_BASE_URL: шрифт з пам'яті замість мережі"""
+    data = _font_bytes(route.request.url.rsplit("/", 1)[-1])
+    if data is None:
+        await route.abort()
+        return
+    await route.fulfill(body=data, content_type="font/ttf", headers={"Access-Control-Allow-Origin": "*"})
+
+def _font_face(family, weight, local_names, file_name=None):
+    # Файл з папки проєкту - першим, щоб не залежати від системних шрифтів
+    sources = []
+    if file_name and _font_bytes(file_name):
+        sources.append(f"url('{FONT_BASE_URL}{file_name}') format('truetype')")
+    sources += [f"local('{n}')" for n in local_names]
+    return (
+        f"@font-face {{ font-family: '{family}'; font-style: normal; font-weight: {weight}; "
+        f"font-display: block; src: {', '.join(sources)}; }}"
+    )
+
+@functools.lru_cache(maxsize=None)
+def get_font_face_css():
+    """@font-face правила з локальними шрифтами - рендер без запитів до Google Fonts"""
+    rules = [
+        _font_face('Roboto', weight, FONT_LOCAL_NAMES[weight], file_name)
+        for weight, file_name in FONT_FILES.items()
+    ]
+    # Емодзі-шрифт великий (~10 МБ), тому він лише з системи (fonts-noto-color-emoji)
+    rules.append(_font_face('Noto Color Emoji', 400, EMOJI_FONT_LOCAL_NAMES))
+    return "\n".join(rules)
+
+@functools.lru_cache(maxsize=64)
+def _load_font(weight, size):
+    path = find_font_file(FONT_FILES[weight])
+    if not path:
+        raise FileNotFoundError(f"Font not found: {FONT_FILES[weight]}")
+    return ImageFont.truetype(path, size)
+
+def can_render_native(text, name, content_image=None):
+    """Чи можна намалювати цитату через Pillow без браузера"""
+    if RENDER_ENGINE != "auto" or content_image:
+        return False
+    if not (find_font_file(FONT_FILES[400]) and find_font_file(FONT_FILES[700])):
+        return False
+    return bool(_NATIVE_TEXT_RE.match(text)) and bool(_NATIVE_TEXT_RE.match(name))
+
+def _text_width(font, text):
+    return font.getlength(text)
+
+def _break_word(word, font, max_width):
+    """Розбиває задовге слово на шматки (як word-break: break-word)"""
+    parts = []
+    while word and _text_width(font, word) > max_width:
+        cut = 1
+        while cut < len(word) and _text_width(font, word[:cut + 1]) <= max_width:
+            cut += 1
+        parts.append(word[:cut])
+        word = word[cut:]
+    if word:
+        parts.append(word)
+    return parts
+
+def _wrap_lines(paragraphs, font, max_width):
+    lines = []
+    for paragraph in paragraphs:
+        line = ""
+        for word in paragraph.split(" "):
+            candidate = f"{line} {word}" if line else word
+            if _text_width(font, candidate) <= max_width:
+                line = candidate
+                continue
+            if line:
+                lines.append(line)
+            pieces = _break_word(word, font, max_width)
+            lines.extend(pieces[:-1])
+            line = pieces[-1] if pieces else ""
+        lines.append(line)
+    return lines
+
+def _draw_shadow(canvas, mask, offset_y, blur, opacity):
+    """Розмита тінь під фігурою (аналог box-shadow)"""
+    alpha = mask.point(lambda v: int(v * opacity))
+    if blur:
+        alpha = alpha.filter(ImageFilter.GaussianBlur(blur / 2))
+    shadow = Image.new("RGBA", canvas.size, (0, 0, 0, 0))
+    shadow.putalpha(alpha)
+    shifted = Image.new("RGBA", canvas.size, (0, 0, 0, 0))
+    shifted.paste(shadow, (0, offset_y))
+    canvas.alpha_composite(shifted)
+
+def _bubble_shape(draw, box, s, fill):
+    """Бульбашка з радіусами 35 35 35 10 (лівий нижній кут гостріший)"""
+    x0, y0, x1, y1 = box
+    radius = BUBBLE_RADIUS * s
+    tail = BUBBLE_TAIL_RADIUS * s
+    draw.rounded_rectangle(box, radius=radius, fill=fill)
+    # Закриваємо великий лівий нижній радіус фігурою з малим радіусом
+    corner = min(radius + tail, (x1 - x0) // 2, (y1 - y0) // 2)
+    draw.rounded_rectangle((x0, y1 - corner, x0 + corner, y1), radius=tail, fill=fill)
+
+def _blend_hex(base_hex, overlay_rgb, opacity):
+    base = ImageColor.getrgb(base_hex)
+    return tuple(int(b * (1 - opacity) + o * opacity) for b, o in zip(base, overlay_rgb))
+
+def render_webp_native(text, name, color_key, avatar=None, theme='dark', quality=None):
+    """Малює стікер через Pillow (без браузера) і повертає WebP байти"""
+    _, profile = get_quality_profile(quality)
+    s = profile["supersample"]
+    bubble_bg, text_color = get_theme_colors(theme)
+    main_color = get_soft_color(color_key)
+
+    name_size, text_size = calculate_font_sizes(len(text), len(name))
+    bubble_max_width = calculate_bubble_width(len(text), len(name))
+    name_font = _load_font(700, name_size * s)
+    text_font = _load_font(400, text_size * s)
+
+    # --- ШИРИНА БУЛЬБАШКИ (display: table у flex-контейнері) ---
+    pad_top, pad_right, pad_bottom, pad_left = BUBBLE_PADDING
+    bubble_extra = pad_left + pad_right + 2 * BUBBLE_BORDER
+    available = (CONTAINER_WIDTH - CONTAINER_PADDING[1] - CONTAINER_PADDING[3]
+                 - AVATAR_SIZE - AVATAR_MARGIN_RIGHT - bubble_extra)
+    max_content = min(bubble_max_width, available) * s
+
+    name_paragraphs = [" ".join(name.split())]
+    text_paragraphs = text.split("\n") if text else []
+    if text_paragraphs and text_paragraphs[-1] == "":
+        text_paragraphs.pop()
+    natural = max(
+        [_text_width(name_font, p) for p in name_paragraphs] +
+        [_text_width(text_font, p) for p in text_paragraphs]
+    )
+    content_width = int(max(BUBBLE_MIN_WIDTH * s, min(max_content, natural)))
+
+    name_lines = _wrap_lines(name_paragraphs, name_font, content_width)
+    text_lines = _wrap_lines(text_paragraphs, text_font, content_width)
+    name_line_h = name_size * 1.2 * s
+    text_line_h = text_size * 1.4 * s
+
+    content_height = len(name_lines) * name_line_h + NAME_MARGIN_BOTTOM * s + len(text_lines) * text_line_h
+    bubble_w = content_width + bubble_extra * s
+    bubble_h = int(content_height + (pad_top + pad_bottom + 2 * BUBBLE_BORDER) * s)
+
+    # --- КОНТЕЙНЕР ---
+    c_top, c_right, c_bottom, c_left = CONTAINER_PADDING
+    inner_h = max(bubble_h, (AVATAR_SIZE + AVATAR_MARGIN_BOTTOM) * s)
+    height = max(CONTAINER_MIN_HEIGHT * s, c_top * s + inner_h + c_bottom * s)
+    width = CONTAINER_WIDTH * s
+    canvas = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    bottom = height - c_bottom * s  # align-items: flex-end
+
+    # --- АВАТАРКА ---
+    ava = AVATAR_SIZE * s
+    ava_x0 = c_left * s
+    ava_y0 = bottom - AVATAR_MARGIN_BOTTOM * s - ava
+    ava_box = (ava_x0, ava_y0, ava_x0 + ava, ava_y0 + ava)
+
+    mask = Image.new("L", canvas.size, 0)
+    ImageDraw.Draw(mask).ellipse(ava_box, fill=255)
+    _draw_shadow(canvas, mask, 4 * s, 8 * s, 0.25)
+
+    avatar_img = Image.new("RGBA", (ava, ava), main_color)
+    if avatar:
+        photo = Image.open(io.BytesIO(avatar)).convert("RGBA")
+        photo = ImageOps.fit(photo, (ava, ava), Image.Resampling.BILINEAR)
+        avatar_img.alpha_composite(photo)
     else:
-        bubble_bg = "#212121"
-        text_color = "#ffffff"
+        letter = name[0].upper() if name else "?"
+        ImageDraw.Draw(avatar_img).text(
+            (ava / 2, ava / 2), letter, font=_load_font(700, 48 * s), fill="white", anchor="mm"
+        )
+    circle = Image.new("L", (ava, ava), 0)
+    ImageDraw.Draw(circle).ellipse((0, 0, ava - 1, ava - 1), fill=255)
+    canvas.paste(avatar_img, (ava_x0, ava_y0), circle)
+
+    # --- БУЛЬБАШКА ---
+    bx0 = (c_left + AVATAR_SIZE + AVATAR_MARGIN_RIGHT) * s
+    by0 = bottom - bubble_h
+    bubble_box = (bx0, by0, bx0 + bubble_w, bottom)
+
+    mask = Image.new("L", canvas.size, 0)
+    _bubble_shape(ImageDraw.Draw(mask), bubble_box, s, 255)
+    _draw_shadow(canvas, mask, 1 * s, 2 * s, 0.15)
+    _draw_shadow(canvas, mask, 4 * s, 12 * s, 0.1)
+
+    draw = ImageDraw.Draw(canvas)
+    border = BUBBLE_BORDER * s
+    _bubble_shape(draw, bubble_box, s, _blend_hex(bubble_bg, (128, 128, 128), 0.15))
+    inner_box = (bx0 + border, by0 + border, bx0 + bubble_w - border, bottom - border)
+    _bubble_shape(draw, inner_box, s, bubble_bg)
+
+    # --- ТЕКСТ ---
+    x = bx0 + border + pad_left * s
+    y = by0 + border + pad_top * s
+    for lines, font, line_h, color in (
+        (name_lines, name_font, name_line_h, main_color),
+        (text_lines, text_font, text_line_h, text_color),
+    ):
+        ascent, descent = font.getmetrics()
+        for line in lines:
+            # Базова лінія по центру рядка, як у CSS line-height
+            baseline = y + (line_h - (ascent + descent)) / 2 + ascent
+            draw.text((x, baseline), line, font=font, fill=color, anchor="ls")
+            y += line_h
+        if font is name_font:
+            y += NAME_MARGIN_BOTTOM * s
+
+    image = canvas
+    if s != 1:
+        image = canvas.resize((CONTAINER_WIDTH, round(height / s)), _resample(profile))
+    output = io.BytesIO()
+    image.save(output, format="WEBP", method=profile["webp_method"])
+    return output.getvalue()
+
+# Чекає шрифти, декодування всіх картинок (аватарка у background і .content-image)
+# і два кадри, щоб layout устиг застосуватись. Повертає false, якщо минув таймаут.
+RENDER_READY_JS = r"""
+async (timeoutMs) => {
+    const ready = (async () => {
+        await document.fonts.ready;
+        const decodes = Array.from(document.images, img => img.decode().catch(() => {}));
+        for (const el of document.querySelectorAll('.avatar')) {
+            const match = getComputedStyle(el).backgroundImage.match(/url\(["']?(.*?)["']?\)/);
+            if (match) {
+                const img = new Image();
+                img.src = match[1];
+                decodes.push(img.decode().catch(() => {}));
+            }
+        }
+        await Promise.all(decodes);
+        await new Promise(resolve => requestAnimationFrame(() => requestAnimationFrame(resolve)));
+        return true;
+    })();
+    const timeout = new Promise(resolve => setTimeout(() => resolve(false), timeoutMs));
+    return Promise.race([ready, timeout]);
+}
+"""
+
+def message_fields(text, name, color_key, avatar=None, content_image=None, theme='dark', **_):
+    """Динамічні поля однієї цитати: CSS-змінні контейнера, літера аватарки, ім'я, текст і картинка"""
+    # --- ТЕМА ---
+    bubble_bg, text_color = get_theme_colors(theme)
 
     # --- КОЛІР ---
     main_color = get_soft_color(color_key)
-    
+
     # --- АВАТАРКА ---
-    if avatar_base64:
-        avatar_bg = f"url('data:image/jpeg;base64,{avatar_base64}')"
+    if avatar:
+        avatar_b64 = base64.b64encode(avatar).decode('ascii')
+        avatar_bg = f"url('data:image/jpeg;base64,{avatar_b64}')"
         avatar_text = ""
     else:
         avatar_bg = main_color
         avatar_text = name[0].upper() if name else "?"
 
     # Картинка всередині повідомлення
-    content_image_block = ""
-    if content_image_base64:
-        content_image_block = f'<img src="data:image/jpeg;base64,{content_image_base64}" class="content-image" />'
+    image = ""
+    if content_image:
+        content_b64 = base64.b64encode(content_image).decode('ascii')
+        image = f"data:image/jpeg;base64,{content_b64}"
 
     # Розрахунок розмірів з урахуванням імені
     name_size, text_size = calculate_font_sizes(len(text), len(name))
     bubble_max_width = calculate_bubble_width(len(text), len(name))
 
-    # Підстановка в HTML
-    html_content = HTML_TEMPLATE.format(
+    style = MESSAGE_STYLE.format(
         avatar_bg=avatar_bg,
-        fallback_color=main_color, 
-        avatar_text=avatar_text,
+        fallback_color=main_color,
         bubble_bg=bubble_bg,
         text_color=text_color,
         name_color=main_color,
         name_size=name_size,
         text_size=text_size,
-        name=name,
-        text=text,
-        content_image_block=content_image_block,
         bubble_max_width=bubble_max_width
     )
+    return {"style": style, "avatar_text": avatar_text, "name": name, "text": text, "image": image}
+
+def build_message_html(**job):
+    """HTML одного контейнера цитати (MESSAGE_TEMPLATE)"""
+    fields = message_fields(**job)
+    image = fields.pop("image")
+    content_image_block = f'<img src="{image}" class="content-image" />' if image else ""
+    return MESSAGE_TEMPLATE.format(content_image_block=content_image_block, **fields)
 
-    # device_scale_factor=3.0 для чіткості + збільшений viewport
-    page = await browser.new_page(
-        viewport={'width': 512, 'height': 2000}, 
-        device_scale_factor=3.0
+# --- РЕЖИМ PATCH ---
+# Сторінки з пулу, в яких уже завантажено шаблон
+_shell_pages = weakref.WeakSet()
+
+@functools.lru_cache(maxsize=None)
+def get_shell_html():
+    """Шаблон без цитат; порожній контейнер лежить у <template> і клонується під кожну цитату"""
+    skeleton = MESSAGE_TEMPLATE.format(style="", avatar_text="", name="", text="", content_image_block="")
+    return HTML_TEMPLATE.format(
+        font_faces=get_font_face_css(),
+        messages=f'<template id="message-template">{skeleton}</template>'
     )
+
+# Підганяє кількість контейнерів під список цитат, оновлює їхні поля
+# і одразу чекає готовності (RENDER_READY_JS) - усе за один виклик page.evaluate
+PATCH_JS = r"""
+async ([quotes, timeoutMs]) => {
+    const template = document.getElementById('message-template');
+    const containers = Array.from(document.querySelectorAll('body > .message-container'));
+    while (containers.length > quotes.length) containers.pop().remove();
+    while (containers.length < quotes.length) {
+        const el = template.content.firstElementChild.cloneNode(true);
+        document.body.appendChild(el);
+        containers.push(el);
+    }
+    quotes.forEach((q, i) => {
+        const el = containers[i];
+        el.setAttribute('style', q.style);
+        el.querySelector('.avatar').innerHTML = q.avatar_text;
+        el.querySelector('.name').innerHTML = q.name;
+        el.querySelector('.text').innerHTML = q.text;
+        let img = el.querySelector('.content-image');
+        if (q.image) {
+            if (!img) {
+                img = document.createElement('img');
+                img.className = 'content-image';
+                el.querySelector('.text').before(img);
+            }
+            img.src = q.image;
+        } else if (img) {
+            img.remove();
+        }
+    });
+    return await (__READY__)(timeoutMs);
+}
+""".replace("__READY__", RENDER_READY_JS.strip())
+
+# Після рендеру прибираємо лише важкі дані (base64 картинок), контейнери лишаються
+PATCH_CLEAR_JS = r"""
+() => {
+    for (const el of document.querySelectorAll('body > .message-container')) {
+        el.style.removeProperty('--avatar-bg');
+        el.querySelector('.content-image')?.remove();
+    }
+}
+"""
+
+async def render_webp_batch(jobs, quality=None):
+    """Рендерить кілька цитат в одній сторінці за один прохід. Повертає список WebP байтів (None - помилка)"""
+    await ensure_browser()
+    supervisor.renders += 1
+
+    _, profile = get_quality_profile(quality)
+    page_pool = get_page_pool(profile["scale"])
+    with RENDER_STAGE_SECONDS.time(stage="page_acquire"):
+        page = await page_pool.acquire()
     
+    screenshots = []
     try:
-        await page.set_content(html_content)
-        # Чекаємо прогрузки шрифтів
-        await page.evaluate("document.fonts.ready")
+        if RENDER_MODE == "patch":
+            if page not in _shell_pages:
+                with RENDER_STAGE_SECONDS.time(stage="shell"):
+                    await page.set_content(get_shell_html())
+                _shell_pages.add(page)
+            # Лише поля цитат, без повторного розбору документа і стилів
+            with RENDER_STAGE_SECONDS.time(stage="patch"):
+                try:
+                    quotes = [message_fields(**job) for job in jobs]
+                    ready = await page.evaluate(PATCH_JS, [quotes, RENDER_READY_TIMEOUT_MS])
+                except Exception:
+                    _shell_pages.discard(page)
+                    raise
+        else:
+            # Підстановка в HTML: усі цитати - окремі контейнери однієї сторінки
+            html_content = HTML_TEMPLATE.format(
+                font_faces=get_font_face_css(),
+                messages="".join(build_message_html(**job) for job in jobs)
+            )
+            with RENDER_STAGE_SECONDS.time(stage="set_content"):
+                await page.set_content(html_content)
+            # Чекаємо рівно до готовності шрифтів, картинок і layout (без фіксованої затримки)
+            with RENDER_STAGE_SECONDS.time(stage="ready"):
+                ready = await page.evaluate(RENDER_READY_JS, RENDER_READY_TIMEOUT_MS)
+        if not ready:
+            print(f"Render readiness timeout ({RENDER_READY_TIMEOUT_MS} ms)")
         
-        # Невелика затримка для повного рендерингу
-        await page.wait_for_timeout(100)
+        elements = await page.query_selector_all('.message-container')
         
-        element = await page.query_selector('.message-container')
+        # Робимо скріншоти у пам'ять, по одному на контейнер
+        with RENDER_STAGE_SECONDS.time(stage="screenshot"):
+            for element in elements:
+                try: screenshots.append(await element.screenshot(omit_background=True))
+                except Exception as e:
+                    print(f"Screenshot error: {e}")
+                    screenshots.append(None)
+    finally:
+        await page_pool.release(page)
+    screenshots += [None] * (len(jobs) - len(screenshots))
+    
+    # Обробка Pillow блокує, тому виконується поза циклом asyncio
+    async def postprocess(png_data):
+        if png_data is None:
+            return None
+        try: return await image_executor.run(postprocess_screenshot, png_data, quality)
+        except Exception as e:
+            print(f"Postprocess error: {e}")
+            return None
+    with RENDER_STAGE_SECONDS.time(stage="postprocess"):
+        return list(await asyncio.gather(*[postprocess(png) for png in screenshots]))
+
+async def render_webp(text, name, color_key, avatar=None, content_image=None, theme='dark', quality=None):
+    """Рендерить стікер у браузері і повертає WebP байти (None, якщо елемент не знайдено)"""
+    job = dict(text=text, name=name, color_key=color_key, avatar=avatar, content_image=content_image, theme=theme)
+    return (await render_webp_batch([job], quality))[0]
+
+# --- ПАКЕТНИЙ РЕНДЕР ---
+class RenderBatcher:
+    """Збирає одночасні рендери одного профілю якості в пакети для render_webp_batch"""
+
+    def __init__(self, window_ms=RENDER_BATCH_WINDOW_MS, max_size=RENDER_BATCH_MAX):
+        self.window = window_ms / 1000
+        self.max_size = max(1, max_size)
+        self.in_flight = 0
+        self._pending = {}  # профіль -> [(job, future)]
+        self._timers = {}
+        self.batches = 0
+        self.jobs = 0
+
+    def enabled(self):
+        return self.window > 0 and self.max_size > 1
+
+    @staticmethod
+    def capacity():
+        """Скільки пакетів рендеряться паралельно: воркери або сторінки пулу"""
+        return render_pool_size if render_pool else PAGE_POOL_MAX
+
+    async def render(self, job, deadline=None):
+        """WebP байти для job (той самий словник, що й у render_webp); deadline обмежує весь пакет"""
+        if not self.enabled():
+            return await asyncio.wait_for(self._render_batch([job], job.get("quality")), self._timeout([deadline]))
+        quality = get_quality_profile(job.get("quality"))[0]
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending.setdefault(quality, [])
+        pending.append((job, future, deadline))
+        if len(pending) >= self.max_size or self.in_flight < self.capacity():
+            # Пакет заповнений або є вільний воркер/сторінка - не чекаємо вікна
+            self._flush(quality)
+        elif quality not in self._timers:
+            self._timers[quality] = asyncio.get_running_loop().call_later(self.window, self._flush, quality)
+        return await future
+
+    def _flush(self, quality):
+        timer = self._timers.pop(quality, None)
+        if timer:
+            timer.cancel()
+        items = [item for item in self._pending.pop(quality, []) if not item[1].done()]
+        if items:
+            # Рахуємо одразу, щоб рендери з цього ж циклу подій уже чекали вікна
+            self.in_flight += 1
+            task = asyncio.ensure_future(self._run(items, quality))
+
+            def on_done(_):
+                # Усі, хто чекав пакет, пішли (дедлайн) - сторінка більше нікому не потрібна
+                if not task.done() and all(future.done() for _, future, _ in items):
+                    task.cancel()
+            for _, future, _ in items:
+                future.add_done_callback(on_done)
+
+    @staticmethod
+    def _timeout(deadlines):
+        """Пакет живе до найпізнішого дедлайну своїх запитів (не довше за RENDER_DEADLINE_S):
+        раніші запити відпадають власними дедлайнами, а коли відпадуть усі - пакет скасовується"""
+        remaining = [d.remaining() for d in deadlines if d is not None]
+        if len(remaining) < len(deadlines):
+            return RENDER_DEADLINE_S
+        return min(RENDER_DEADLINE_S, max(remaining))
+
+    async def _run(self, items, quality):
+        self.batches += 1
+        self.jobs += len(items)
+        try:
+            # Зависла сторінка не повинна тримати пакет (і всіх, хто його чекає) довше за дедлайн
+            results = await asyncio.wait_for(
+                self._render_batch([job for job, _, _ in items], quality),
+                self._timeout([deadline for _, _, deadline in items])
+            )
+        except Exception as e:
+            for _, future, _ in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.in_flight -= 1
+        for (_, future, _), result in zip(items, results):
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    async def _render_batch(jobs, quality):
+        if render_pool:
+            return await _render_in_worker(_worker_render_batch, jobs, quality)
+        return await render_webp_batch(jobs, quality)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "jobs": self.jobs,
+            "avg_batch": self.jobs / self.batches if self.batches else 0.0,
+        }
+
+render_batcher = RenderBatcher()
+
+def postprocess_screenshot(png_data, quality=None):
+    """Зменшує скріншот до 512px і кодує у WebP"""
+    _, profile = get_quality_profile(quality)
+    
+    # --- ОБРОБКА PIL (Pillow) для якості ---
+    image = Image.open(io.BytesIO(png_data))
+    
+    # Зменшуємо до 512px по ширині фільтром з профілю (LANCZOS для "max")
+    if image.size[0] != 512:
+        w_percent = (512 / float(image.size[0]))
+        h_size = int((float(image.size[1]) * float(w_percent)))
+        image = image.resize((512, h_size), _resample(profile))
+    
+    # Зберігаємо у буфер як WebP (стандарт для стікерів)
+    output = io.BytesIO()
+    image.save(output, format="WEBP", method=profile["webp_method"])
+    return output.getvalue()
+
+# --- КЕШ СТІКЕРІВ ---
+class StickerCache:
+    """LRU/TTL кеш: хеш вмісту цитати -> file_id вже завантаженого стікера"""
+
+    def __init__(self, max_size=STICKER_CACHE_SIZE, ttl=STICKER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text, name, color_key, avatar=None, content_image=None, theme='dark', quality=None):
+        def digest(value):
+            return hashlib.sha256(value).hexdigest() if value else ""
+        parts = [
+            TEMPLATE_VERSION, text, name, get_soft_color(color_key),
+            digest(avatar), digest(content_image), theme, get_quality_profile(quality)[0]
+        ]
+        return hashlib.sha256("\x00".join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None or item[1] < time.monotonic():
+            if item is not None:
+                del self._items[key]
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def put(self, key, file_id):
+        if self.max_size <= 0:
+            return
+        self._items[key] = (file_id, time.monotonic() + self.ttl)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def discard(self, key):
+        self._items.pop(key, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+sticker_cache = StickerCache()
+
+async def render_sticker_webp(text, name, color_key, avatar=None, content_image=None, theme='dark', quality=None,
+                              deadline=None):
+    """WebP байти стікера: нативний рушій, якщо цитата проста, інакше браузер. Повертає (рушій, байти)"""
+    if can_render_native(text, name, content_image):
+        try:
+            with RENDER_STAGE_SECONDS.time(stage="native"):
+                webp_data = await image_executor.run(
+                    render_webp_native, text, name, color_key, avatar, theme, quality
+                )
+            return "native", webp_data
+        except Exception as e:
+            # Браузер лишається запасним варіантом
+            print(f"Native render error: {e}")
+    job = dict(
+        text=text, name=name, color_key=color_key,
+        avatar=avatar, content_image=content_image, theme=theme, quality=quality
+    )
+    # Одночасні цитати рендеряться разом в одній сторінці (у воркері або тут)
+    engine = "worker" if render_pool else "browser"
+    with RENDER_STAGE_SECONDS.time(stage=engine):
+        return engine, await render_batcher.render(job, deadline)
+
+async def render_sticker(bot, chat_id, text, name, color_key, avatar=None, content_image=None, theme='dark', quality=None,
+                         deadline=None):
+    # Така сама цитата вже була - просто пересилаємо file_id без рендеру і завантаження
+    cache_key = sticker_cache.make_key(text, name, color_key, avatar, content_image, theme, quality)
+    file_id = sticker_cache.get(cache_key)
+    if file_id:
+        try:
+            with RENDER_STAGE_SECONDS.time(stage="cached_send"):
+                await bot.send_sticker(chat_id, sticker=file_id)
+            RENDERS_TOTAL.inc(engine="cache", result="ok")
+            return
+        except Exception as e:
+            print(f"Cached sticker error: {e}")
+            sticker_cache.discard(cache_key)
+
+    engine = "browser"
+    started = time.perf_counter()
+    try:
+        engine, webp_data = await render_sticker_webp(
+            text, name, color_key, avatar, content_image, theme, quality, deadline
+        )
         
-        if element:
-            # Робимо скріншот у пам'ять
-            png_data = await element.screenshot(omit_background=True)
-            
-            # --- ОБРОБКА PIL (Pillow) для якості ---
-            image = Image.open(io.BytesIO(png_data))
-            
-            # Зменшуємо до 512px по ширині з використанням якісного алгоритму LANCZOS
-            w_percent = (512 / float(image.size[0]))
-            h_size = int((float(image.size[1]) * float(w_percent)))
-            image = image.resize((512, h_size), Image.Resampling.LANCZOS)
-            
-            # Зберігаємо у буфер як WebP (стандарт для стікерів)
-            output = io.BytesIO()
-            image.save(output, format="WEBP")
-            output.seek(0)
-            
+        if webp_data:
             from aiogram.types import BufferedInputFile
-            input_file = BufferedInputFile(output.read(), filename="sticker.webp")
-            await bot.send_sticker(chat_id, sticker=input_file)
+            input_file = BufferedInputFile(webp_data, filename="sticker.webp")
+            with RENDER_STAGE_SECONDS.time(stage="upload"):
+                msg = await bot.send_sticker(chat_id, sticker=input_file)
+            if msg.sticker:
+                sticker_cache.put(cache_key, msg.sticker.file_id)
+            RENDERS_TOTAL.inc(engine=engine, result="ok")
         else:
+            RENDERS_TOTAL.inc(engine=engine, result="error")
             await bot.send_message(chat_id, "Error rendering sticker (element not found)")
             
+    except (asyncio.CancelledError, asyncio.TimeoutError):
+        # Дедлайн запиту минув - повідомлення (error_render_timeout) надсилає той, хто його поставив
+        RENDERS_TOTAL.inc(engine=engine, result="cancelled")
+        raise
     except Exception as e:
         print(f"Render error: {e}")
+        RENDERS_TOTAL.inc(engine=engine, result="error")
         await bot.send_message(chat_id, "Render error occurred.")
     finally:
-        await page.close()
+        RENDER_STAGE_SECONDS.observe(time.perf_counter() - started, stage="total")
 
-def delete_message_safe(bot, chat_id, msg_id):
-    import asyncio
-    async def _delete():
-        if not msg_id: return
-        try:
-            await bot.delete_message(chat_id, msg_id)
-        except:
-            pass
-    return asyncio.create_task(_delete())
\ No newline at end of file
+async def render_sticker_file_id(bot, storage_chat_id, text, name, color_key, avatar=None, theme='dark', quality=None,
+                                 deadline=None):
+    """file_id стікера (для inline-відповідей): з кешу, або рендер і завантаження у службовий чат"""
+    cache_key = sticker_cache.make_key(text, name, color_key, avatar, None, theme, quality)
+    file_id = sticker_cache.get(cache_key)
+    if file_id:
+        RENDERS_TOTAL.inc(engine="cache", result="ok")
+        return file_id
+
+    engine = "browser"
+    started = time.perf_counter()
+    try:
+        engine, webp_data = await render_sticker_webp(text, name, color_key, avatar, None, theme, quality, deadline)
+        if not webp_data:
+            RENDERS_TOTAL.inc(engine=engine, result="error")
+            return None
+        from aiogram.types import BufferedInputFile
+        with RENDER_STAGE_SECONDS.time(stage="upload"):
+            msg = await bot.send_sticker(storage_chat_id, sticker=BufferedInputFile(webp_data, filename="sticker.webp"))
+        # file_id лишається дійсним і після видалення повідомлення
+        delete_message_safe(bot, storage_chat_id, msg.message_id)
+        RENDERS_TOTAL.inc(engine=engine, result="ok")
+        sticker_cache.put(cache_key, msg.sticker.file_id)
+        return msg.sticker.file_id
+    except (asyncio.CancelledError, asyncio.TimeoutError):
+        RENDERS_TOTAL.inc(engine=engine, result="cancelled")
+        raise
+    except Exception:
+        RENDERS_TOTAL.inc(engine=engine, result="error")
+        raise
+    finally:
+        RENDER_STAGE_SECONDS.observe(time.perf_counter() - started, stage="total")
+
+# --- ВИДАЛЕННЯ ПОВІДОМЛЕНЬ ---
+class DeletionScheduler:
+    """Відкладене видалення: купа (час, чат, повідомлення) і один фоновий цикл замість задачі на кожне повідомлення"""
+
+    def __init__(self, batch_window_ms=DELETE_BATCH_WINDOW_MS, rate=DELETE_RATE):
+        self.batch_window = batch_window_ms / 1000
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._heap = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._next_call = 0.0
+        self.deleted = 0
+        self.calls = 0
+
+    def schedule(self, bot, chat_id, msg_id, delay=0):
+        if not msg_id:
+            return
+        seq = next(self._seq)
+        heapq.heappush(self._heap, (time.monotonic() + delay, seq, bot, chat_id, msg_id))
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        elif self._heap[0][1] == seq:
+            # Нове повідомлення має видалитись раніше за всі інші - будимо цикл
+            self._wakeup.set()
+
+    def _pop_due(self, until):
+        due = []
+        while self._heap and self._heap[0][0] <= until:
+            due.append(heapq.heappop(self._heap))
+        return due
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0][0] - time.monotonic()
+            if delay > 0:
+                self._wakeup.clear()
+                try: await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError: pass
+                continue
+            # Найраніше повідомлення вже можна видаляти - притримуємо його на вікно,
+            # щоб ті, чий час настане за цей проміжок, пішли тим самим викликом (раніше строку - жодне)
+            hold = self._heap[0][0] + self.batch_window - time.monotonic()
+            if hold > 0:
+                await asyncio.sleep(hold)
+            await self._delete(self._pop_due(time.monotonic()))
+
+    async def _delete(self, due):
+        groups = collections.defaultdict(list)
+        for _, _, bot, chat_id, msg_id in due:
+            groups[(bot, chat_id)].append(msg_id)
+        for (bot, chat_id), msg_ids in groups.items():
+            # Bot API видаляє до 100 повідомлень одного чату за виклик
+            for i in range(0, len(msg_ids), 100):
+                chunk = msg_ids[i:i + 100]
+                await self._throttle()
+                try:
+                    if len(chunk) == 1:
+                        await bot.delete_message(chat_id, chunk[0])
+                    else:
+                        await bot.delete_messages(chat_id, chunk)
+                    self.deleted += len(chunk)
+                except Exception:
+                    pass
+
+    async def _throttle(self):
+        now = time.monotonic()
+        if self._next_call > now:
+            await asyncio.sleep(self._next_call - now)
+        self._next_call = max(now, self._next_call) + self.interval
+        self.calls += 1
+
+    async def flush(self):
+        """Видаляє все заплановане одразу (при зупинці бота)"""
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+        await self._delete(self._pop_due(float("inf")))
+
+    def stats(self):
+        return {"pending": len(self._heap), "deleted": self.deleted, "calls": self.calls}
+
+deletion_scheduler = DeletionScheduler()
+
+def delete_message_safe(bot, chat_id, msg_id, delay=0):
+    """Ставить повідомлення в чергу на видалення через delay секунд і одразу повертається"""
+    deletion_scheduler.schedule(bot, chat_id, msg_id, delay)
+
+# --- МЕТРИКИ СТАНУ ---
+# Значення читаються з об'єктів у момент запиту /metrics
+def _pool_stat(field):
+    return sum(pool.stats()[field] for pool in page_pools.values())
+
+Gauge("quoteyou_render_queue_depth", "Renders waiting for a slot", fn=lambda: render_queue.stats()["queued"])
+Gauge("quoteyou_render_queue_users", "Users with renders waiting for a slot", fn=lambda: render_queue.stats()["users_queued"])
+Gauge("quoteyou_renders_in_flight", "Renders currently running", fn=lambda: render_queue.stats()["in_flight"])
+CounterFunc("quoteyou_render_rejected_total", "Renders rejected because the queue was full", fn=lambda: render_queue.rejected)
+Gauge("quoteyou_browser_renders", "Render passes since the current browser was launched", fn=lambda: supervisor.renders)
+Gauge("quoteyou_browser_pages", "Pooled browser pages", ["state"], fn=lambda: {
+    ("idle",): _pool_stat("idle"),
+    ("busy",): _pool_stat("size") - _pool_stat("idle"),
+})
+CounterFunc("quoteyou_page_pool_events_total", "Page pool acquisitions", ["result"], fn=lambda: {
+    ("hit",): _pool_stat("hits"), ("miss",): _pool_stat("misses"), ("wait",): _pool_stat("waits"),
+})
+CounterFunc("quoteyou_page_pool_wait_seconds_total", "Time spent waiting for a free page", fn=lambda: _pool_stat("wait_time"))
+CounterFunc("quoteyou_sticker_cache_total", "Sticker file_id cache lookups", ["result"], fn=lambda: {
+    ("hit",): sticker_cache.hits, ("miss",): sticker_cache.misses,
+})
+CounterFunc("quoteyou_avatar_cache_total", "Avatar cache lookups", ["result"], fn=lambda: {
+    ("hit",): avatar_cache.hits, ("negative_hit",): avatar_cache.negative_hits,
+    ("revalidated",): avatar_cache.revalidated, ("miss",): avatar_cache.misses,
+})
+CounterFunc("quoteyou_render_batches_total", "Browser page passes (batches)", fn=lambda: render_batcher.batches)
+CounterFunc("quoteyou_render_batch_jobs_total", "Quotes rendered through batches", fn=lambda: render_batcher.jobs)
+Gauge("quoteyou_deletions_pending", "Messages scheduled for deletion", fn=lambda: deletion_scheduler.stats()["pending"])
+CounterFunc("quoteyou_deleted_messages_total", "Messages deleted by the scheduler", fn=lambda: deletion_scheduler.deleted)
+Gauge("quoteyou_image_jobs_in_flight", "Pillow jobs running in the image executor", fn=lambda: image_executor.in_flight)
+CounterFunc("quoteyou_image_job_seconds_total", "Pillow job time in the image executor", ["phase"], fn=lambda: {
+    ("wait",): image_executor.wait_time, ("run",): image_executor.run_time,
+})
+Gauge("quoteyou_blob_store_bytes", "Bytes held by the blob store", ["tier"], fn=lambda: {
+    ("memory",): blob_store.stats()["memory_bytes"], ("disk",): blob_store.stats()["disk_bytes"],
+})
+Gauge("quoteyou_process_resident_memory_bytes", "Resident memory", ["scope"], fn=lambda: {
+    ("self",): _self_rss(), ("tree",): process_tree_rss(),
+})